@@ -1,10 +1,20 @@
 from pyramid.config import Configurator
+from pyramid.exceptions import ConfigurationError
 from pyramid.settings import asbool
 import pyramid.tweens
 
+from pyramid_debugtoolbar.panels.gc import GCDebugPanel, tracker as gc_tracker
+from pyramid_debugtoolbar.panels.lifecycle import (
+    LifecycleDebugPanel,
+    instrument_lifecycle,
+)
+from pyramid_debugtoolbar.panels.performance import PerformanceDebugPanel
 from pyramid_debugtoolbar.toolbar import (
+    IPanelMap,
     IRequestAuthorization,
     IToolbarWSGIApp,
+    get_panel_classes,
+    invalidate_global_panels,
     toolbar_tween_factory,
 )
 from pyramid_debugtoolbar.toolbar_app import IParentActions, make_toolbar_app
@@ -13,11 +23,16 @@ from pyramid_debugtoolbar.utils import (
     STATIC_PATH,
     as_cr_separated_list,
     as_display_debug_or_false,
+    as_float,
     as_int,
     as_list,
+    as_rate,
+    as_rate_map,
+    get_setting,
 )
 
 toolbar_tween_factory = toolbar_tween_factory  # API
+invalidate_global_panels = invalidate_global_panels  # API
 
 default_hosts = ('127.0.0.1', '::1')
 
@@ -36,8 +51,20 @@ default_settings = [
     ('includes', as_list, ()),
     ('button_style', None, ''),
     ('max_request_history', as_int, 100),
+    ('max_history_bytes', as_int, 0),
+    ('background_workers', as_int, 0),
+    ('profiler', None, 'cprofile'),
+    ('profiler_interval', as_float, 1.0),
+    ('tracemalloc_frames', as_int, 10),
+    ('tween_timing', asbool, 'false'),
+    ('sqla_repeat_threshold', as_int, 3),
+    ('sqla_stack_frames', as_int, 5),
+    ('history_backend', None, 'memory'),
+    ('history_path', None, ''),
     ('max_visible_requests', as_int, 10),
     ('show_on_exc_only', asbool, 'false'),
+    ('sample_rate', as_rate, 1.0),
+    ('route_sample_rates', as_rate_map, ()),
 ]
 
 # We need to transform these from debugtoolbar. to pyramid. in our
@@ -61,7 +88,12 @@ def parse_settings(settings):
         name = '%s%s' % (SETTINGS_PREFIX, name)
         value = settings.get(name, default)
         if convert is not None:
-            value = convert(value)
+            try:
+                value = convert(value)
+            except ValueError as e:
+                raise ConfigurationError(
+                    'Invalid value for the %s setting: %s' % (name, e)
+                )
         parsed[name] = value
 
     # Extend the ones we are going to transform later ...
@@ -137,6 +169,16 @@ def includeme(config):
         'set_debugtoolbar_request_authorization',
         set_request_authorization_callback,
     )
+    # some panels rely on hooks in the application or the interpreter,
+    # which would slow down every request without them
+    panel_classes = ()
+    if get_setting(settings, 'enabled'):
+        panel_map = application.registry.queryUtility(IPanelMap, default={})
+        panel_classes = get_panel_classes(settings, panel_map, False)
+    if LifecycleDebugPanel in panel_classes:
+        instrument_lifecycle(config)
+    if GCDebugPanel in panel_classes or PerformanceDebugPanel in panel_classes:
+        gc_tracker.install()
 
     # register routes and views that can be used within the tween
     config.add_route('debugtoolbar', '/_debug_toolbar/*subpath', static=True)
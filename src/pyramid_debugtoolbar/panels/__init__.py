@@ -3,6 +3,8 @@ from pyramid.i18n import get_localizer
 from pyramid.renderers import render
 from pyramid.threadlocal import get_current_request
 
+from pyramid_debugtoolbar.utils import estimate_size
+
 
 class DebugPanel(object):
     """
@@ -18,9 +20,16 @@ class DebugPanel(object):
     - :meth:`.wrap_handler`
     - :meth:`.process_beforerender`
     - :meth:`.process_response`
+    - :meth:`.process_deferred`
+    - :meth:`.freeze`
 
     Each of these hooks is overridable by a subclass to gleen information
-    from the request and other events for later display.
+    from the request and other events for later display. The toolbar only
+    invokes :meth:`.wrap_handler`, :meth:`.process_beforerender` and
+    :meth:`.process_response` on panels overriding them. A panel which
+    :attr:`.user_activate` and either overrides none of them or does not
+    :attr:`.record_inactive` is not created at all until the user activates
+    it.
 
     The panel is later used to render its results. This is done on-demand
     and in the lifecycle of a request to the debug toolbar by invoking
@@ -48,6 +57,12 @@ class DebugPanel(object):
     #: is ``False`` then ``is_active`` will always be set to ``True``.
     is_active = False
 
+    #: If ``False`` then a :attr:`.user_activate` panel is not created at
+    #: all until the user activates it, and none of its hooks are invoked.
+    #: Panels recording something even while inactive, such as the time
+    #: taken by the request, should leave it to ``True``.
+    record_inactive = True
+
     #: Must be overridden by subclasses that are using the default
     #: implementation of ``render_content``. This is an
     #: :term:`asset specification` pointing at the template to be rendered
@@ -154,6 +169,44 @@ class DebugPanel(object):
         """
         return handler
 
+    def process_deferred(self):
+        """Invoked once the request is finished, before :meth:`.freeze`.
+
+        Override this method to do the expensive processing of the data
+        recorded by the panel, such as formatting it for display. It is
+        invoked by a finished callback of the request, which Pyramid runs
+        before returning the response to the WSGI server, unless the
+        ``debugtoolbar.background_workers`` setting is used: it is then
+        invoked by a background thread and does not delay the response. The
+        request is finished and must not be relied upon.
+        """
+        pass
+
+    def freeze(self):
+        """Invoked once the request is finished, after every other hook.
+
+        Override this method to convert the data recorded by the panel into
+        compact, immutable values and to drop any reference to the original
+        request and response, or other objects tied to the request such as
+        database connections. This reduces the memory retained by the
+        request history and allows the panel to be pickled by history
+        backends shared between processes.
+        """
+        pass
+
+    def estimate_size(self, seen):
+        """Return an estimate, in bytes, of the memory retained by the panel.
+
+        Invoked after :meth:`.freeze` when the
+        ``debugtoolbar.max_history_bytes`` setting is used. The default
+        implementation walks every object referenced by the panel.
+
+        ``seen`` is a set containing the ``id`` of the objects already
+        accounted for by the toolbar and should be passed along to
+        :func:`pyramid_debugtoolbar.utils.estimate_size`.
+        """
+        return estimate_size(self, seen)
+
     def render_vars(self, request):
         """Invoked by the default implementation of :meth:`.render_content`
         and should return a ``dict`` of values to use when rendering the
@@ -0,0 +1,134 @@
+import gc
+import threading
+import time
+
+from pyramid_debugtoolbar.panels import DebugPanel
+
+_ = lambda x: x
+
+
+class CollectionTracker(object):
+    """
+    A :data:`gc.callbacks` hook timing the garbage collections. Collections
+    are accounted to the thread triggering them, which is the thread paused
+    while the collector runs.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def __call__(self, phase, info):
+        local = self.local
+        now = time.perf_counter()
+        if phase == 'start':
+            local.start = now
+            return
+        start = getattr(local, 'start', None)
+        if start is None:
+            # the collection started before the hook was installed
+            return
+        local.start = None
+        duration = now - start
+        local.pause_time = getattr(local, 'pause_time', 0.0) + duration
+        collections = getattr(local, 'collections', None)
+        if collections is not None:
+            collections.append(
+                {
+                    'generation': info['generation'],
+                    'collected': info['collected'],
+                    'uncollectable': info['uncollectable'],
+                    'duration': duration * 1000,
+                }
+            )
+
+    def install(self):
+        """
+        Add the hook to :data:`gc.callbacks`, unless it is already there.
+        """
+        if self not in gc.callbacks:
+            gc.callbacks.append(self)
+
+    def pause_time(self):
+        """
+        Return the time, in seconds, the current thread spent in garbage
+        collections since the hook was installed.
+        """
+        return getattr(self.local, 'pause_time', 0.0)
+
+    def record(self):
+        """
+        Return a list to which the collections of the current thread are
+        appended until :meth:`.stop` is called.
+        """
+        self.local.collections = collections = []
+        return collections
+
+    def stop(self):
+        self.local.collections = None
+
+
+# installed by the toolbar when the GC or the performance panel is enabled,
+# as it runs on every collection of the process
+tracker = CollectionTracker()
+
+
+class GCDebugPanel(DebugPanel):
+    """
+    Panel displaying the garbage collections triggered while handling the
+    request, and the time the request was paused by them.
+    """
+
+    name = 'gc'
+    has_content = True
+    template = 'pyramid_debugtoolbar.panels:templates/gc.dbtmako'
+    title = _('Garbage Collection')
+    nav_title = _('GC')
+    collections = None
+
+    def wrap_handler(self, handler):
+        def gc_handler(request):
+            self.collections = tracker.record()
+            try:
+                return handler(request)
+            finally:
+                tracker.stop()
+
+        return gc_handler
+
+    @property
+    def nav_subtitle(self):
+        if self.data.get('collections'):
+            return '%0.2fms' % self.data['pause_time']
+
+    def process_response(self, response):
+        collections = self.collections or []
+        generations = [
+            {
+                'generation': generation,
+                'count': 0,
+                'collected': 0,
+                'uncollectable': 0,
+                'pause_time': 0.0,
+                'threshold': threshold,
+            }
+            for generation, threshold in enumerate(gc.get_threshold())
+        ]
+        for collection in collections:
+            generation = generations[collection['generation']]
+            generation['count'] += 1
+            generation['collected'] += collection['collected']
+            generation['uncollectable'] += collection['uncollectable']
+            generation['pause_time'] += collection['duration']
+        self.data = {
+            'collections': tuple(collections),
+            'generations': generations,
+            'pause_time': sum(c['duration'] for c in collections),
+            'enabled': gc.isenabled(),
+        }
+
+    def freeze(self):
+        self.collections = None
+
+
+def includeme(config):
+    config.add_debugtoolbar_panel(GCDebugPanel)
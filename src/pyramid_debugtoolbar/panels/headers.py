@@ -39,6 +39,11 @@ class HeaderDebugPanel(DebugPanel):
             response_headers = [(k, v) for k, v in sorted(response.headerlist)]
             self.data['response_headers'] = response_headers
 
+    def freeze(self):
+        self.response = None
+        self.data['request_headers'] = tuple(self.data['request_headers'])
+        self.data['response_headers'] = tuple(self.data['response_headers'])
+
 
 def includeme(config):
     config.add_debugtoolbar_panel(HeaderDebugPanel)
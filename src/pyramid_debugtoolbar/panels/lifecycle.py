@@ -0,0 +1,177 @@
+from pyramid.events import BeforeRender, ContextFound, NewRequest, NewResponse
+import time
+
+from pyramid_debugtoolbar.panels import DebugPanel
+
+try:
+    from pyramid.events import BeforeTraversal
+except ImportError:  # pragma: no cover
+    # Pyramid < 1.9
+    BeforeTraversal = None
+try:
+    from pyramid.viewderivers import preserve_view_attrs
+except ImportError:  # pragma: no cover
+    # Pyramid < 1.7 does not support view derivers
+    preserve_view_attrs = None
+
+_ = lambda x: x
+
+# the phase of the request starting at each mark, the other marks are
+# displayed in the timeline only
+phases = {
+    'start': _('Tweens'),
+    'NewRequest': _('Routing'),
+    'BeforeTraversal': _('Traversal'),
+    'ContextFound': _('View lookup, security and predicates'),
+    'view': _('View callable'),
+    'view_end': _('Rendering'),
+    'render_end': _('Response finalization'),
+    'end': _('Debug toolbar and outer tweens'),
+}
+
+
+def _mark(request, name):
+    marks = getattr(request, 'pdtb_lifecycle', None)
+    if marks is not None:
+        marks.append((name, time.perf_counter()))
+
+
+def lifecycle_subscriber(event):
+    _mark(event.request, event.__class__.__name__)
+
+
+def beforerender_subscriber(event):
+    request = event.get('request')
+    if request is not None:
+        _mark(request, 'BeforeRender')
+
+
+def view_timer(view, info):
+    """
+    A view deriver marking the start and the end of the view callable,
+    placed just above the mapped view such that the rendering is excluded.
+    """
+
+    def timed_view(context, request):
+        _mark(request, 'view')
+        try:
+            return view(context, request)
+        finally:
+            _mark(request, 'view_end')
+
+    preserve_view_attrs(view, timed_view)
+    return timed_view
+
+
+def render_timer(view, info):
+    """
+    A view deriver marking the end of the rendering of the view's result.
+    """
+
+    def timed_render(context, request):
+        try:
+            return view(context, request)
+        finally:
+            _mark(request, 'render_end')
+
+    preserve_view_attrs(view, timed_render)
+    return timed_render
+
+
+def instrument_lifecycle(config):
+    """
+    Register the subscribers and the view derivers timestamping the phases
+    of a request in the application.
+    """
+    config.add_subscriber(lifecycle_subscriber, NewRequest)
+    config.add_subscriber(lifecycle_subscriber, ContextFound)
+    config.add_subscriber(lifecycle_subscriber, NewResponse)
+    config.add_subscriber(beforerender_subscriber, BeforeRender)
+    if BeforeTraversal is not None:  # pragma: no branch
+        config.add_subscriber(lifecycle_subscriber, BeforeTraversal)
+    if preserve_view_attrs is not None:  # pragma: no branch
+        config.add_view_deriver(
+            render_timer,
+            'pdtb_render_timer',
+            under='decorated_view',
+            over='rendered_view',
+        )
+        config.add_view_deriver(
+            view_timer,
+            'pdtb_view_timer',
+            under='rendered_view',
+            over='mapped_view',
+        )
+
+
+class LifecycleDebugPanel(DebugPanel):
+    """
+    Panel breaking down the time spent in each phase of the request, from
+    the events emitted by Pyramid and the start and end of the view callable.
+    """
+
+    name = 'lifecycle'
+    has_content = True
+    template = 'pyramid_debugtoolbar.panels:templates/lifecycle.dbtmako'
+    title = _('Request Lifecycle')
+    nav_title = _('Lifecycle')
+    marks = None
+
+    def wrap_handler(self, handler):
+        def lifecycle_handler(request):
+            marks = self.marks = [('start', time.perf_counter())]
+            request.pdtb_lifecycle = marks
+            try:
+                return handler(request)
+            finally:
+                marks.append(('end', time.perf_counter()))
+
+        return lifecycle_handler
+
+    def process_deferred(self):
+        # NewResponse is emitted after every tween, so the last phase also
+        # includes the tweens above the toolbar
+        marks = self.marks
+        if not marks:
+            return
+        origin = marks[0][1]
+        timeline = []
+        durations = {}
+        phase = None
+        previous = origin
+        for name, timestamp in marks:
+            ends_phase = name in phases or name == 'NewResponse'
+            if ends_phase and phase is not None:
+                durations[phase] = durations.get(phase, 0.0) + (
+                    timestamp - previous
+                )
+            if name in phases:
+                phase = phases[name]
+                previous = timestamp
+            timeline.append((name, (timestamp - origin) * 1000))
+        total = sum(durations.values())
+        self.data = {
+            'phases': tuple(
+                (
+                    label,
+                    durations[label] * 1000,
+                    durations[label] / total * 100 if total else 0,
+                )
+                for label in dict.fromkeys(phases.values())
+                if label in durations
+            ),
+            'timeline': tuple(timeline),
+            'total': total * 1000,
+        }
+
+    @property
+    def nav_subtitle(self):
+        if self.data:
+            return '%0.2fms' % self.data['total']
+
+    def freeze(self):
+        self.marks = None
+
+
+def includeme(config):
+    config.add_debugtoolbar_panel(LifecycleDebugPanel)
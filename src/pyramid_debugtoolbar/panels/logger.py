@@ -71,6 +71,9 @@ class LoggingPanel(DebugPanel):
         records = self.get_and_delete()
         self.data = {'records': records}
 
+    def freeze(self):
+        self.data['records'] = tuple(self.data['records'])
+
     @property
     def has_content(self):
         if self.data['records']:
@@ -0,0 +1,225 @@
+import threading
+import tracemalloc
+
+from pyramid_debugtoolbar.panels import DebugPanel
+from pyramid_debugtoolbar.utils import (
+    format_fname,
+    get_registry_singleton,
+    get_setting,
+)
+
+_ = lambda x: x
+
+# tracemalloc traces the allocations of every thread of the process, a
+# single request is traced at once such that they are not mixed up
+lock = threading.Lock()
+
+# allocations made by the tracing itself
+ignored_traces = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+)
+
+
+def format_size(size):
+    """Return a number of bytes in a human readable form."""
+    if abs(size) < 1024:
+        return '%d B' % size
+    for unit in ('KiB', 'MiB'):
+        size /= 1024.0
+        if abs(size) < 1024:
+            return '%.1f %s' % (size, unit)
+    return '%.1f GiB' % (size / 1024.0)
+
+
+def get_route_allocations(registry):
+    """
+    Return the dictionary mapping each route name to the memory allocated by
+    the last traced request it matched.
+    """
+    return get_registry_singleton(registry, 'pdtb_route_allocations', dict)
+
+
+class MemoryDebugPanel(DebugPanel):
+    """
+    Panel tracing the memory allocated by a request using :mod:`tracemalloc`.
+
+    It displays the peak and the net memory allocated while handling the
+    request, the sites responsible for the memory still allocated once the
+    request is handled, and how they compare with the previous request
+    matching the same route.
+    """
+
+    name = 'memory'
+    user_activate = True
+    record_inactive = False
+    has_content = True
+    template = 'pyramid_debugtoolbar.panels:templates/memory.dbtmako'
+    title = _('Memory')
+    nav_title = title
+    #: The number of allocation sites listed in each table.
+    top = 20
+    snapshot = None
+    route_name = None
+
+    def __init__(self, request):
+        self.frames = get_setting(
+            request.registry.settings, 'tracemalloc_frames'
+        )
+        self.route_allocations = get_route_allocations(request.registry)
+        self.data = {'traced': False}
+
+    def wrap_handler(self, handler):
+        if not self.is_active:
+            return handler
+
+        def memory_handler(request):
+            with lock:
+                started = not tracemalloc.is_tracing()
+                if started:
+                    tracemalloc.start(self.frames)
+                    before = None
+                else:
+                    before = tracemalloc.take_snapshot()
+                if hasattr(tracemalloc, 'reset_peak'):  # pragma: no branch
+                    tracemalloc.reset_peak()
+                initial = tracemalloc.get_traced_memory()[0]
+                self.frames = tracemalloc.get_traceback_limit()
+                try:
+                    return handler(request)
+                finally:
+                    size, peak = tracemalloc.get_traced_memory()
+                    self.snapshot = tracemalloc.take_snapshot()
+                    self.before = before
+                    if started:
+                        tracemalloc.stop()
+                    self.peak = peak - initial
+                    self.net = size - initial
+                    route = request.matched_route
+                    self.route_name = route.name if route else None
+
+        return memory_handler
+
+    @property
+    def nav_subtitle(self):
+        if self.data['traced']:
+            return format_size(self.data['peak'])
+
+    def process_response(self, response):
+        if self.snapshot is not None:
+            self.data = {
+                'traced': True,
+                'peak': self.peak,
+                'net': self.net,
+                'route_name': self.route_name,
+                'lines': [],
+                'tracebacks': [],
+                'diff': None,
+            }
+
+    def _statistics(self, key_type):
+        snapshot = self.snapshot.filter_traces(ignored_traces)
+        if self.before is None:
+            return snapshot.statistics(key_type)
+        before = self.before.filter_traces(ignored_traces)
+        return [
+            stat
+            for stat in snapshot.compare_to(before, key_type)
+            if stat.size_diff > 0
+        ]
+
+    def process_deferred(self):
+        if self.snapshot is None:
+            return
+        data = self.data
+        lines = self._statistics('lineno')[: self.top]
+        data['lines'] = [_site_row(stat) for stat in lines]
+        if self.frames > 1:
+            data['tracebacks'] = [
+                _site_row(stat, traceback=True)
+                for stat in self._statistics('traceback')[: self.top]
+            ]
+
+        if self.route_name is not None:
+            # only the displayed sites are kept for the next request
+            sites = {
+                (stat.traceback[-1].filename, stat.traceback[-1].lineno): (
+                    _stat_size(stat)
+                )
+                for stat in lines
+            }
+            previous = self.route_allocations.get(self.route_name)
+            self.route_allocations[self.route_name] = {
+                'peak': self.peak,
+                'net': self.net,
+                'sites': sites,
+            }
+            if previous is not None:
+                data['diff'] = {
+                    'peak': self.peak - previous['peak'],
+                    'net': self.net - previous['net'],
+                    'sites': _diff_rows(previous['sites'], sites, self.top),
+                }
+        # snapshots are as large as the number of live allocations
+        self.snapshot = self.before = None
+
+    def freeze(self):
+        self.snapshot = self.before = None
+        self.route_allocations = None
+        for name in ('lines', 'tracebacks'):
+            if name in self.data:
+                self.data[name] = tuple(self.data[name])
+        if self.data.get('diff'):
+            self.data['diff']['sites'] = tuple(self.data['diff']['sites'])
+
+    def render_vars(self, request):
+        return {'format_size': format_size}
+
+
+def _stat_size(stat):
+    return getattr(stat, 'size_diff', stat.size)
+
+
+def _stat_count(stat):
+    return getattr(stat, 'count_diff', stat.count)
+
+
+def _site_row(stat, traceback=False):
+    # the most recent frame is the last one
+    frame = stat.traceback[-1]
+    row = {
+        'size': _stat_size(stat),
+        'count': _stat_count(stat),
+        'file': format_fname(frame.filename),
+        'file_long': frame.filename,
+        'line': frame.lineno,
+    }
+    if traceback:
+        row['traceback'] = [
+            (format_fname(frame.filename), frame.lineno)
+            for frame in stat.traceback
+        ]
+    return row
+
+
+def _diff_rows(previous, current, top):
+    rows = []
+    for site in set(previous) | set(current):
+        diff = current.get(site, 0) - previous.get(site, 0)
+        if diff:
+            filename, lineno = site
+            rows.append(
+                {
+                    'size': current.get(site, 0),
+                    'size_diff': diff,
+                    'file': format_fname(filename),
+                    'file_long': filename,
+                    'line': lineno,
+                }
+            )
+    rows.sort(key=lambda row: abs(row['size_diff']), reverse=True)
+    return rows[:top]
+
+
+def includeme(config):
+    config.add_debugtoolbar_panel(MemoryDebugPanel)
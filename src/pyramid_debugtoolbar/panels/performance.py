@@ -18,15 +18,51 @@ except ImportError:  # pragma: no cover
     # separately from python for god-knows-what-reason
     pstats = None
 
+from contextlib import nullcontext
+import heapq
+import json
+import marshal
+import os
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.renderers import render
+from pyramid.response import Response
+from pyramid.view import view_config
+import sys
 import threading
 import time
+from urllib.parse import urlencode
 
 from pyramid_debugtoolbar.panels import DebugPanel
-from pyramid_debugtoolbar.utils import format_fname
+from pyramid_debugtoolbar.panels.gc import tracker as gc_tracker
+from pyramid_debugtoolbar.profiler import (
+    SamplingProfiler,
+    call_tree,
+    chrome_trace,
+    collapsed_stacks,
+)
+from pyramid_debugtoolbar.utils import (
+    STATIC_PATH,
+    format_fname,
+    get_registry_singleton,
+    get_setting,
+)
 
 _ = lambda x: x
 
-lock = threading.Lock()
+# the resource usage of the thread handling the request, only supported by
+# Linux, otherwise the resource usage of the whole process
+if resource is not None:
+    rusage_who = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+else:  # pragma: no cover
+    rusage_who = None
+
+if sys.version_info >= (3, 12):
+    # cProfile relies on sys.monitoring which only allows a single profiler
+    # to be active in the process
+    lock = threading.Lock()
+else:
+    # cProfile only profiles the thread enabling it
+    lock = nullcontext()
 
 
 class PerformanceDebugPanel(DebugPanel):
@@ -34,13 +70,19 @@ class PerformanceDebugPanel(DebugPanel):
     Panel that looks at the performance of a request.
 
     It will display the time a request took and, optionally, the
-    cProfile output.
+    cProfile output or the output of a statistical profiler, depending on the
+    ``debugtoolbar.profiler`` setting.
     """
 
     name = 'performance'
     user_activate = True
     stats = None
-    function_calls = None
+    profiler = None
+    route_profiles = None
+    # the name of the route matched by the profiled request
+    route_name = None
+    # the time of each stack recorded by the sampling profiler
+    stack_times = None
     has_resource = bool(resource)
     has_content = bool(pstats and profile)
     template = 'pyramid_debugtoolbar.panels:templates/performance.dbtmako'
@@ -48,84 +90,68 @@ class PerformanceDebugPanel(DebugPanel):
     nav_title = title
 
     def __init__(self, request):
-        if profile is not None:
+        self.pdtb_id = request.pdtb_id
+        self.registry = request.registry
+
+    def _make_profiler(self):
+        # only the requests of an active panel are profiled
+        self.route_profiles = get_route_profiles(self.registry)
+        settings = self.registry.settings
+        if get_setting(settings, 'profiler') == 'sampling':
+            interval = get_setting(settings, 'profiler_interval')
+            self.profiler = SamplingProfiler(interval / 1000)
+        elif profile is not None:
             self.profiler = profile.Profile()
 
     def _wrap_timer_handler(self, handler):
-        if self.has_resource:
-
-            def resource_timer_handler(request):
-                _start_time = time.monotonic()
-                self._start_rusage = resource.getrusage(resource.RUSAGE_SELF)
-                try:
-                    result = handler(request)
-                finally:
-                    self._end_rusage = resource.getrusage(resource.RUSAGE_SELF)
-                    self.total_time = (time.monotonic() - _start_time) * 1000
-
-                return result
-
-            return resource_timer_handler
-
-        def noresource_timer_handler(request):
+        def timer_handler(request):
+            if self.has_resource:
+                self._start_rusage = resource.getrusage(rusage_who)
+            _start_gc_time = gc_tracker.pause_time()
+            _start_thread_time = time.thread_time()
             _start_time = time.monotonic()
             try:
-                result = handler(request)
+                return handler(request)
             finally:
                 self.total_time = (time.monotonic() - _start_time) * 1000
-            return result
+                self.cpu_time = (
+                    time.thread_time() - _start_thread_time
+                ) * 1000
+                self.gc_time = (
+                    gc_tracker.pause_time() - _start_gc_time
+                ) * 1000
+                if self.has_resource:
+                    self._end_rusage = resource.getrusage(rusage_who)
 
-        return noresource_timer_handler
+        return timer_handler
 
     def _wrap_profile_handler(self, handler):
         if not self.is_active:
             return handler
 
+        self._make_profiler()
+        if isinstance(self.profiler, SamplingProfiler):
+            # the sampling profiler only records the current thread
+
+            def sampling_profile_handler(request):
+                try:
+                    return self.profiler.runcall(handler, request)
+                finally:
+                    self.route_name = _route_name(request)
+                    # no samples are taken from the fastest requests
+                    if self.profiler.samples:
+                        self.stack_times = self.profiler.times
+                        self.stats = pstats.Stats(self.profiler)
+
+            return sampling_profile_handler
+
         def profile_handler(request):
             with lock:
                 try:
                     result = self.profiler.runcall(handler, request)
                 finally:
-                    stats = pstats.Stats(self.profiler)
-                    function_calls = []
-                    flist = stats.sort_stats('cumulative').fcn_list
-                    for func in flist:
-                        current = {}
-                        info = stats.stats[func]
-
-                        # Number of calls
-                        if info[0] != info[1]:
-                            current['ncalls'] = '%d/%d' % (info[1], info[0])
-                        else:
-                            current['ncalls'] = info[1]
-
-                        # Total time
-                        current['tottime'] = info[2] * 1000
-
-                        # Quotient of total time divided by number of calls
-                        if info[1]:
-                            current['percall'] = info[2] * 1000 / info[1]
-                        else:
-                            current['percall'] = 0
-
-                        # Cumulative time
-                        current['cumtime'] = info[3] * 1000
-
-                        # Quotient of the cumulative time divded by the number
-                        # of primitive calls.
-                        if info[0]:
-                            current['percall_cum'] = info[3] * 1000 / info[0]
-                        else:
-                            current['percall_cum'] = 0
-
-                        # Filename
-                        filename = pstats.func_std_string(func)
-                        current['filename_long'] = filename
-                        current['filename'] = format_fname(filename)
-                        function_calls.append(current)
-
-                    self.stats = stats
-                    self.function_calls = function_calls
+                    self.route_name = _route_name(request)
+                    self.stats = pstats.Stats(self.profiler)
 
                 return result
 
@@ -136,6 +162,15 @@ class PerformanceDebugPanel(DebugPanel):
         handler = self._wrap_timer_handler(handler)
         return handler
 
+    def freeze(self):
+        # the profiler duplicates the stats, and the stats refer to the
+        # stream used to print them, usually sys.stdout
+        self.profiler = None
+        self.route_profiles = None
+        self.registry = None
+        if self.stats is not None:
+            self.stats.stream = None
+
     @property
     def nav_subtitle(self):
         return '%0.2fms' % (self.total_time)
@@ -146,12 +181,59 @@ class PerformanceDebugPanel(DebugPanel):
         )
 
     def process_response(self, response):
-        vars = {'timing_rows': None, 'stats': None, 'function_calls': []}
+        vars = {
+            'timing_rows': None,
+            'stats': None,
+            'sampling': None,
+        }
+        # the time the thread was not running: waiting for I/O, a lock or
+        # the GIL held by another thread
+        off_cpu_time = max(self.total_time - self.cpu_time, 0)
+        rows = []
         if self.has_resource:
             utime = 1000 * self._elapsed_ru('ru_utime')
             stime = 1000 * self._elapsed_ru('ru_stime')
+            if rusage_who == resource.RUSAGE_SELF:
+                # includes the other threads handling concurrent requests
+                rows.extend(
+                    (
+                        (_('User CPU time (process)'), '%0.3f msec' % utime),
+                        (_('System CPU time (process)'), '%0.3f msec' % stime),
+                    )
+                )
+            else:
+                rows.extend(
+                    (
+                        (_('User CPU time'), '%0.3f msec' % utime),
+                        (_('System CPU time'), '%0.3f msec' % stime),
+                    )
+                )
+        # TODO l10n on values
+        rows.extend(
+            (
+                (_('Total CPU time'), '%0.3f msec' % self.cpu_time),
+                (_('Off-CPU time'), '%0.3f msec' % off_cpu_time),
+                (_('Elapsed time'), '%0.3f msec' % self.total_time),
+                (
+                    _('CPU utilization'),
+                    (
+                        '%0.1f%%' % (self.cpu_time / self.total_time * 100)
+                        if self.total_time
+                        else '-'
+                    ),
+                ),
+                (_('Garbage collection'), '%0.3f msec' % self.gc_time),
+            )
+        )
+        if self.has_resource:
             vcsw = self._elapsed_ru('ru_nvcsw')
             ivcsw = self._elapsed_ru('ru_nivcsw')
+            rows.append(
+                (
+                    _('Context switches'),
+                    '%d voluntary, %d involuntary' % (vcsw, ivcsw),
+                )
+            )
             # minflt = self._elapsed_ru('ru_minflt')
             # majflt = self._elapsed_ru('ru_majflt')
 
@@ -167,30 +249,366 @@ class PerformanceDebugPanel(DebugPanel):
             # srss = self._end_rusage.ru_ixrss
             # urss = self._end_rusage.ru_idrss
             # usrss = self._end_rusage.ru_isrss
-
-            # TODO l10n on values
-            rows = (
-                (_('User CPU time'), '%0.3f msec' % utime),
-                (_('System CPU time'), '%0.3f msec' % stime),
-                (_('Total CPU time'), '%0.3f msec' % (utime + stime)),
-                (_('Elapsed time'), '%0.3f msec' % self.total_time),
-                (
-                    _('Context switches'),
-                    '%d voluntary, %d involuntary' % (vcsw, ivcsw),
-                ),
-                # (_('Memory use'), '%d max RSS, %d shared, %d unshared' % (
-                #     rss, srss, urss + usrss)),
-                # (_('Page faults'), '%d no i/o, %d requiring i/o' % (
-                #     minflt, majflt)),
-                # (_('Disk operations'), '%d in, %d out, %d swapout' % (
-                #     blkin, blkout, swap)),
-            )
-            vars['timing_rows'] = rows
+        vars['timing_rows'] = tuple(rows)
         if self.is_active:
             vars['stats'] = self.stats
-            vars['function_calls'] = self.function_calls
+            if isinstance(self.profiler, SamplingProfiler):
+                vars['sampling'] = {
+                    'samples': self.profiler.samples,
+                    'interval': self.profiler.interval * 1000,
+                }
         self.data = vars
 
+    def process_deferred(self):
+        if self.stats is not None:
+            self.route_profiles.add(
+                self.route_name, self.stats, self.total_time
+            )
+
+    def function_calls(self, sort='cumtime', module='', offset=0, limit=100):
+        """
+        Return the number of profiled functions whose location contains
+        ``module`` and the rows of ``limit`` of them, starting at ``offset``,
+        once sorted by the ``sort`` column.
+
+        Only the requested rows are formatted, the stats of a large
+        application may contain tens of thousands of functions.
+
+        """
+        stats = self.stats.stats
+        items = stats.items()
+        if module:
+            needles = {module, module.replace('.', os.sep)}
+            items = [
+                item
+                for item in items
+                if any(
+                    needle in pstats.func_std_string(item[0])
+                    for needle in needles
+                )
+            ]
+        total = len(items)
+        select = heapq.nsmallest if sort == 'filename' else heapq.nlargest
+        items = select(offset + limit, items, key=sort_keys[sort])[offset:]
+        return total, [_function_row(func, info) for func, info in items]
+
+    def call_tree(self):
+        """
+        Return the call tree of the profile, see
+        :func:`pyramid_debugtoolbar.profiler.call_tree`.
+        """
+        if self.stats is None:
+            return None
+        return call_tree(self.stats.stats, self.stack_times)
+
+    def function_table(self, request, **kw):
+        """
+        Return the rendering context of the table of profiled functions, see
+        :meth:`.function_calls` for the arguments.
+        """
+        kw.setdefault('sort', 'cumtime')
+        kw.setdefault('module', '')
+        kw.setdefault('offset', 0)
+        kw.setdefault('limit', 100)
+        total, rows = self.function_calls(**kw)
+        url = request.route_url(
+            'debugtoolbar.performance_functions', request_id=self.pdtb_id
+        )
+
+        def page_url(**changes):
+            query = dict(kw, **changes)
+            if not query['module']:
+                del query['module']
+            return url + '?' + urlencode(query)
+
+        return dict(
+            kw,
+            total=total,
+            rows=rows,
+            columns=columns,
+            url=url,
+            page_url=page_url,
+        )
+
+    def render_vars(self, request):
+        vars = {
+            'pdtb_id': self.pdtb_id,
+            'route_name': self.route_name,
+            'route_url': request.route_url,
+            'static_path': request.static_url(STATIC_PATH),
+            'function_table': None,
+        }
+        if self.stats is not None:
+            vars['function_table'] = render(
+                functions_template, self.function_table(request), request
+            )
+        return vars
+
+
+class RouteProfiles(object):
+    """
+    The profiles of the requests handled by the application, merged by the
+    route they matched. Requests matching no route are merged together
+    under the ``None`` route name.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        # guards the merged stats from concurrent requests
+        self.lock = threading.Lock()
+
+    def add(self, route_name, stats, elapsed):
+        """
+        Merge the :class:`pstats.Stats` of a request which took ``elapsed``
+        milliseconds.
+        """
+        with self.lock:
+            route = self.routes.get(route_name)
+            if route is None:
+                route = self.routes[route_name] = {
+                    'requests': 0,
+                    'elapsed': 0.0,
+                    'stats': pstats.Stats(),
+                }
+            route['requests'] += 1
+            route['elapsed'] += elapsed
+            route['stats'].add(stats)
+
+    def summary(self, top):
+        """
+        Return the number of requests, their average time and the ``top``
+        functions with the highest total time of each route.
+        """
+        with self.lock:
+            routes = sorted(self.routes.items(), key=lambda r: str(r[0]))
+            return [
+                {
+                    'route_name': route_name,
+                    'requests': route['requests'],
+                    'elapsed': route['elapsed'] / route['requests'],
+                    'function_calls': [
+                        _function_row(func, info)
+                        for func, info in heapq.nlargest(
+                            top,
+                            route['stats'].stats.items(),
+                            key=sort_keys['tottime'],
+                        )
+                    ],
+                }
+                for route_name, route in routes
+            ]
+
+
+def get_route_profiles(registry):
+    """
+    Return the :class:`.RouteProfiles` of the application, to which the
+    performance panel adds the profile of every request.
+    """
+    return get_registry_singleton(
+        registry, 'pdtb_route_profiles', RouteProfiles
+    )
+
+
+class RouteProfilesDebugPanel(DebugPanel):
+    """
+    Global panel displaying the functions with the highest total time in the
+    profiles of every request matching the same route, merged as they are
+    handled.
+    """
+
+    name = 'route_profiles'
+    has_content = bool(pstats and profile)
+    template = 'pyramid_debugtoolbar.panels:templates/route_profiles.dbtmako'
+    title = _('Route Profiles')
+    nav_title = title
+    #: The number of functions listed for each route.
+    top = 20
+
+    def __init__(self, request):
+        self.route_profiles = get_route_profiles(request.registry)
+
+    def render_vars(self, request):
+        return {'routes': self.route_profiles.summary(self.top)}
+
+
+def _route_name(request):
+    route = request.matched_route
+    return route.name if route is not None else None
+
+
+def _function_row(func, info):
+    cc, nc, tt, ct, callers = info
+    filename = pstats.func_std_string(func)
+    return {
+        'ncalls': '%d/%d' % (nc, cc) if cc != nc else nc,
+        'calls': nc,
+        'tottime': tt * 1000,
+        # total time divided by the number of calls
+        'percall': tt * 1000 / nc if nc else 0,
+        'cumtime': ct * 1000,
+        # cumulative time divided by the number of primitive calls
+        'percall_cum': ct * 1000 / cc if cc else 0,
+        'filename_long': filename,
+        'filename': format_fname(filename),
+    }
+
+
+# the columns of the table of profiled functions and the keys sorting them
+columns = (
+    ('ncalls', _('Calls')),
+    ('tottime', _('Total')),
+    ('percall', _('Percall')),
+    ('cumtime', _('Cumu')),
+    ('percall_cum', _('CumuPer')),
+    ('filename', _('Func')),
+)
+sort_keys = {
+    'ncalls': lambda item: item[1][1],
+    'tottime': lambda item: item[1][2],
+    'percall': lambda item: item[1][2] / item[1][1] if item[1][1] else 0,
+    'cumtime': lambda item: item[1][3],
+    'percall_cum': lambda item: item[1][3] / item[1][0] if item[1][0] else 0,
+    'filename': lambda item: pstats.func_std_string(item[0]),
+}
+functions_template = (
+    'pyramid_debugtoolbar.panels:templates/performance_functions.dbtmako'
+)
+
+
+class PerformanceViews(object):
+    def __init__(self, request):
+        self.request = request
+
+    def find_panel(self):
+        request_id = self.request.matchdict['request_id']
+        toolbar = self.request.pdtb_history.get(request_id)
+        if toolbar is None:
+            raise HTTPBadRequest('No history found for request.')
+        toolbar.wait()
+        for panel in toolbar.panels:
+            if panel.name == 'performance' and panel.stats is not None:
+                return panel
+        raise HTTPNotFound('The request was not profiled.')
+
+    def find_call_tree(self):
+        return self.find_panel().call_tree()
+
+    def attachment(self, body, content_type, filename):
+        if isinstance(body, str):
+            response = Response(
+                body, content_type=content_type, charset='utf-8'
+            )
+        else:
+            response = Response(body, content_type=content_type)
+        response.content_disposition = 'attachment; filename="%s"' % filename
+        return response
+
+    @view_config(route_name='debugtoolbar.performance_dump')
+    def dump(self):
+        stats = self.find_panel().stats
+        return self.attachment(
+            marshal.dumps(stats.stats),
+            'application/octet-stream',
+            '%s.prof' % self.request.matchdict['request_id'],
+        )
+
+    @view_config(route_name='debugtoolbar.performance_route_dump')
+    def route_dump(self):
+        route_name = self.request.matchdict['name']
+        history = self.request.pdtb_history
+        stats = None
+        for request_id, toolbar in history.last(len(history)):
+            toolbar.wait()
+            for panel in toolbar.panels:
+                if (
+                    panel.name == 'performance'
+                    and getattr(panel, 'stats', None) is not None
+                    and panel.route_name == route_name
+                ):
+                    if stats is None:
+                        stats = pstats.Stats()
+                    stats.add(panel.stats)
+        if stats is None:
+            raise HTTPNotFound('No request matching this route was profiled.')
+        return self.attachment(
+            marshal.dumps(stats.stats),
+            'application/octet-stream',
+            'route-%s.prof' % route_name,
+        )
+
+    @view_config(
+        route_name='debugtoolbar.performance_functions',
+        renderer=functions_template,
+    )
+    def functions(self):
+        params = self.request.params
+        sort = params.get('sort', 'cumtime')
+        if sort not in sort_keys:
+            raise HTTPBadRequest('Unknown column %r.' % sort)
+        try:
+            offset = max(int(params.get('offset', 0)), 0)
+            limit = min(max(int(params.get('limit', 100)), 1), 1000)
+        except ValueError:
+            raise HTTPBadRequest('Invalid offset or limit.')
+        return self.find_panel().function_table(
+            self.request,
+            sort=sort,
+            module=params.get('module', '').strip(),
+            offset=offset,
+            limit=limit,
+        )
+
+    @view_config(
+        route_name='debugtoolbar.performance_flamegraph', renderer='json'
+    )
+    def flamegraph(self):
+        return self.find_call_tree()
+
+    @view_config(route_name='debugtoolbar.performance_collapsed')
+    def collapsed(self):
+        tree = self.find_call_tree()
+        return self.attachment(
+            collapsed_stacks(tree),
+            'text/plain',
+            '%s.collapsed.txt' % self.request.matchdict['request_id'],
+        )
+
+    @view_config(route_name='debugtoolbar.performance_trace')
+    def trace(self):
+        tree = self.find_call_tree()
+        return self.attachment(
+            json.dumps(chrome_trace(tree)),
+            'application/json',
+            '%s.trace.json' % self.request.matchdict['request_id'],
+        )
+
 
 def includeme(config):
+    config.add_route(
+        'debugtoolbar.performance_dump',
+        '/{request_id}/performance/profile.prof',
+    )
+    config.add_route(
+        'debugtoolbar.performance_route_dump',
+        '/performance/routes/{name}/profile.prof',
+    )
+    config.add_route(
+        'debugtoolbar.performance_functions',
+        '/{request_id}/performance/functions',
+    )
+    config.add_route(
+        'debugtoolbar.performance_flamegraph',
+        '/{request_id}/performance/flamegraph',
+    )
+    config.add_route(
+        'debugtoolbar.performance_collapsed',
+        '/{request_id}/performance/collapsed',
+    )
+    config.add_route(
+        'debugtoolbar.performance_trace',
+        '/{request_id}/performance/trace',
+    )
+
     config.add_debugtoolbar_panel(PerformanceDebugPanel)
+    config.add_debugtoolbar_panel(RouteProfilesDebugPanel, is_global=True)
+    config.scan(__name__)
@@ -44,6 +44,10 @@ class RenderingsDebugPanel(DebugPanel):
     def process_response(self, response):
         self.data = {'renderings': self.renderings}
 
+    def freeze(self):
+        self.renderings = tuple(self.renderings)
+        self.data['renderings'] = self.renderings
+
 
 def includeme(config):
     config.add_debugtoolbar_panel(RenderingsDebugPanel)
@@ -144,6 +144,25 @@ class RequestVarsDebugPanel(DebugPanel):
         # stop hanging onto the request after the response is processed
         del self.request
 
+    def freeze(self):
+        # the extracted attributes are live objects like the context or the
+        # exception, keep the text displayed by the template instead
+        extracted_attributes = {}
+        for attr_, value in self.data['extracted_attributes'].items():
+            if isinstance(value, dict):
+                value = {k: safe_str(v) for k, v in value.items()}
+            else:
+                value = safe_str(value)
+            extracted_attributes[attr_] = value
+        self.data['extracted_attributes'] = extracted_attributes
+
+
+def safe_str(value):
+    try:
+        return str(value)
+    except Exception:
+        return '<unknown>'
+
 
 def install_attribute_listener(target, cb):
     orig_getattribute = target.__class__.__getattribute__
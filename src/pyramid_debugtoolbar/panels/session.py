@@ -1,5 +1,4 @@
 from pyramid.interfaces import ISessionFactory
-import zope.interface.interfaces
 
 from pyramid_debugtoolbar.panels import DebugPanel
 from pyramid_debugtoolbar.utils import dictrepr, wrap_load
@@ -57,13 +56,9 @@ class SessionDebugPanel(DebugPanel):
         }
         # we need this for processing in the response phase
         self._request = request
-        # try to stash the configuration info
-        try:
-            config = request.registry.getUtility(ISessionFactory)
-            data["configuration"] = config
-        except zope.interface.interfaces.ComponentLookupError:
-            # the `ISessionFactory` is not configured
-            pass
+        # stash the configuration info, `None` if the `ISessionFactory` is
+        # not configured
+        data["configuration"] = request.registry.queryUtility(ISessionFactory)
 
     def wrap_handler(self, handler):
         """
@@ -211,6 +206,15 @@ class SessionDebugPanel(DebugPanel):
                     ):
                         data["session_data"]["changed"].add(k)
 
+    def freeze(self):
+        self._request = None
+        data = self.data
+        if data["configuration"] is not None:
+            data["configuration"] = str(data["configuration"])
+        session_data = data["session_data"]
+        session_data["keys"] = frozenset(session_data["keys"])
+        session_data["changed"] = frozenset(session_data["changed"])
+
 
 def includeme(config):
     config.add_debugtoolbar_panel(SessionDebugPanel)
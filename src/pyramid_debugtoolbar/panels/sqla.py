@@ -1,17 +1,90 @@
+import heapq
 import json
+import linecache
+import os
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.threadlocal import get_current_request
 from pyramid.view import view_config
+import random
+import re
+import sys
 import threading
 import time
 from urllib.parse import quote
 import weakref
 
 from pyramid_debugtoolbar.panels import DebugPanel
-from pyramid_debugtoolbar.utils import ROOT_ROUTE_NAME, STATIC_PATH, format_sql
+from pyramid_debugtoolbar.tbtools import SOURCE_TABLE_HTML, Line
+from pyramid_debugtoolbar.utils import (
+    ROOT_ROUTE_NAME,
+    STATIC_PATH,
+    format_fname,
+    format_sql,
+    get_registry_singleton,
+    get_setting,
+)
 
 lock = threading.Lock()
 
+# the packages executing the statements on behalf of the application, their
+# frames are left out of the call stacks
+ignored_packages = ('sqlalchemy', 'pyramid', 'pyramid_debugtoolbar')
+
+# whether the frames of each code object are left out of the call stacks
+_ignored_codes = {}
+
+# the normalizations applied, in order, to compute the fingerprint of a
+# statement
+fingerprint_patterns = [
+    (re.compile(r'--[^\n]*|/\*.*?\*/', re.S), ' '),
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    # bind parameters of the various DBAPI paramstyles
+    (re.compile(r'%\(\w+\)s|%s|(?<![:\w]):\w+|\$\d+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\bIN \(\s?\?(?:\s?,\s?\?)*\s?\)', re.I), 'IN (...)'),
+]
+
+
+def fingerprint(statement):
+    """
+    Return the fingerprint of a SQL statement, the statement with its
+    comments removed, its literals and bind parameters replaced by ``?``
+    and its ``IN`` lists collapsed, such that the statements differing only
+    by their values share the same fingerprint.
+    """
+    for pattern, replacement in fingerprint_patterns:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip().rstrip(';').rstrip()
+
+
+def _is_ignored(module):
+    package = (module or '').partition('.')[0]
+    return package in ignored_packages
+
+
+def _capture_stack(limit):
+    """
+    Return the ``limit`` innermost frames of the application executing a
+    statement, as ``(filename, lineno, funcname)`` tuples.
+    """
+    stack = []
+    if len(_ignored_codes) > 10000:
+        # code objects created at runtime, e.g. by template engines
+        _ignored_codes.clear()
+    frame = sys._getframe(1)
+    while frame is not None and len(stack) < limit:
+        code = frame.f_code
+        ignored = _ignored_codes.get(code)
+        if ignored is None:
+            ignored = _is_ignored(frame.f_globals.get('__name__'))
+            _ignored_codes[code] = ignored
+        if not ignored:
+            stack.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return tuple(stack)
+
+
 try:
     from sqlalchemy import event
     from sqlalchemy.engine.base import Engine
@@ -25,6 +98,8 @@ try:
         stop_timer = time.monotonic()
         request = get_current_request()
         if request is not None and hasattr(request, 'pdtb_sqla_queries'):
+            limit = get_setting(request.registry.settings, 'sqla_stack_frames')
+            stack = _capture_stack(limit) if limit else ()
             with lock:
                 engines = request.registry.pdtb_sqla_engines
                 engines[id(conn.engine)] = weakref.ref(conn.engine)
@@ -37,6 +112,7 @@ try:
                         'statement': stmt,
                         'parameters': params,
                         'context': context,
+                        'stack': stack,
                     }
                 )
         delattr(conn, 'pdtb_start_timer')
@@ -59,6 +135,7 @@ try:
                         'statement': '-- [event] %s' % stmt,
                         'parameters': '',
                         'context': '',
+                        'stack': (),
                     }
                 )
 
@@ -126,15 +203,32 @@ class SQLADebugPanel(DebugPanel):
     template = 'pyramid_debugtoolbar.panels:templates/sqlalchemy.dbtmako'
     title = _('SQLAlchemy Queries')
     nav_title = _('SQLAlchemy')
+    route_name = None
 
     def __init__(self, request):
         self.queries = request.pdtb_sqla_queries = []
+        # engines can only be used from the process which recorded the queries
+        self.pid = os.getpid()
+        self.statistics = get_query_statistics(request.registry)
+        self.repeat_threshold = get_setting(
+            request.registry.settings, 'sqla_repeat_threshold'
+        )
         if hasattr(request.registry, 'pdtb_sqla_engines'):
             self.engines = request.registry.pdtb_sqla_engines
         else:
             self.engines = request.registry.pdtb_sqla_engines = {}
         self.pdtb_id = request.pdtb_id
 
+    def wrap_handler(self, handler):
+        def sqla_handler(request):
+            try:
+                return handler(request)
+            finally:
+                route = getattr(request, 'matched_route', None)
+                self.route_name = route.name if route is not None else None
+
+        return sqla_handler
+
     @property
     def has_content(self):
         if self.queries:
@@ -145,23 +239,52 @@ class SQLADebugPanel(DebugPanel):
     @property
     def nav_subtitle(self):
         if self.queries:
+            n_plus_one = len(self.data.get('n_plus_one') or ())
+            if n_plus_one:
+                return "%d (%d N+1)" % (len(self.queries), n_plus_one)
             return "%d" % (len(self.queries))
 
+    @property
+    def nav_subtitle_style(self):
+        if self.data.get('n_plus_one'):
+            return 'progress-bar-warning'
+
     def process_response(self, response):
+        engine_urls = {}
+        for engine_id, engine_ref in list(self.engines.items()):
+            engine = engine_ref()
+            engine_urls[engine_id] = engine.url if engine else None
+
+        self.data = {
+            'queries': [],
+            'engine_urls': engine_urls,
+            'repeated': [],
+            'n_plus_one': [],
+            'duplicates': [],
+        }
+
+    def process_deferred(self):
         data = []
+        executions = {}
         for index, query in enumerate(self.queries):
             stmt = query['statement']
 
             is_select = stmt.strip().lower().startswith('select')
             params = ''
+            serialized = None
             try:
-                params = quote(json.dumps(query['parameters']))
+                serialized = json.dumps(query['parameters'])
+                params = quote(serialized)
             except TypeError:
                 pass  # object not JSON serializable
             except ValueError:
                 pass  # JSON parameters serialization can generate ValueError
             except UnicodeDecodeError:
                 pass  # parameters contain non-utf8 (probably binary) data
+            if not stmt.startswith('-- [event]'):
+                if serialized is None:
+                    serialized = repr(query['parameters'])
+                executions.setdefault((stmt, serialized), []).append(index)
 
             data.append(
                 {
@@ -174,13 +297,89 @@ class SQLADebugPanel(DebugPanel):
                     'is_select': is_select,
                     'context': query['context'],
                     'query_index': index,
+                    'stack': tuple(
+                        (format_fname(filename), filename, lineno, funcname)
+                        for filename, lineno, funcname in query['stack']
+                    ),
                 }
             )
-
-        self.data = {
-            'queries': data,
-            'engines': self.engines,
-        }
+        self.data['queries'] = data
+        groups = self._group_statements()
+        self.statistics.add(
+            self.route_name,
+            [(key, group['durations']) for key, group in groups.items()],
+        )
+        repeated = [
+            _repeated_row(group)
+            for group in groups.values()
+            if group['count'] > 1
+        ]
+        repeated.sort(key=lambda group: (-group['count'], -group['duration']))
+        self.data['repeated'] = repeated
+        self.data['n_plus_one'] = [
+            group
+            for group in repeated
+            if group['count'] > self.repeat_threshold
+        ]
+        duplicates = [
+            {
+                'sql': format_sql(stmt),
+                'count': len(indices),
+                # the time that would be saved by executing it once
+                'duration': sum(
+                    self.queries[index]['duration'] for index in indices[1:]
+                ),
+                'indices': tuple(indices),
+                'parameters': self.queries[indices[0]]['parameters'],
+            }
+            for (stmt, serialized), indices in executions.items()
+            if len(indices) > 1
+        ]
+        duplicates.sort(key=lambda row: (-row['count'], -row['duration']))
+        self.data['duplicates'] = duplicates
+
+    def _group_statements(self):
+        """Group the statements executed by the request by fingerprint."""
+        groups = {}
+        for index, query in enumerate(self.queries):
+            if query['statement'].startswith('-- [event]'):
+                continue
+            key = fingerprint(query['statement'])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    'fingerprint': key,
+                    'count': 0,
+                    'duration': 0.0,
+                    'durations': [],
+                    'indices': [],
+                    'call_sites': {},
+                }
+            group['count'] += 1
+            group['duration'] += query['duration']
+            group['durations'].append(query['duration'])
+            group['indices'].append(index)
+            if query['stack']:
+                call_site = query['stack'][0]
+                call_sites = group['call_sites']
+                call_sites[call_site] = call_sites.get(call_site, 0) + 1
+        return groups
+
+    def freeze(self):
+        # the execution context refers to the connection and the cursor
+        self.queries = tuple(
+            {k: v for k, v in query.items() if k != 'context'}
+            for query in self.queries
+        )
+        self.data['queries'] = tuple(
+            {k: v for k, v in query.items() if k != 'context'}
+            for query in self.data['queries']
+        )
+        for name in ('repeated', 'n_plus_one', 'duplicates'):
+            if name in self.data:
+                self.data[name] = tuple(self.data[name])
+        self.engines = None
+        self.statistics = None
 
     def render_content(self, request):
         if not self.queries:
@@ -193,9 +392,154 @@ class SQLADebugPanel(DebugPanel):
             'route_url': request.route_url,
             'static_path': request.static_url(STATIC_PATH),
             'root_path': request.route_url(ROOT_ROUTE_NAME),
+            'repeat_threshold': self.repeat_threshold,
+            'engines_available': self.pid == os.getpid(),
         }
 
 
+def _repeated_row(group):
+    call_sites = sorted(group['call_sites'].items(), key=lambda item: -item[1])
+    return {
+        'fingerprint': group['fingerprint'],
+        'sql': format_sql(group['fingerprint']),
+        'count': group['count'],
+        'duration': group['duration'],
+        'indices': tuple(group['indices']),
+        'call_sites': tuple(
+            (format_fname(filename), filename, lineno, funcname, count)
+            for (filename, lineno, funcname), count in call_sites
+        ),
+    }
+
+
+class QueryStatistics(object):
+    """
+    The statistics of the statements executed by the requests handled by the
+    application, aggregated by fingerprint as the requests are handled.
+
+    At most ``max_statements`` fingerprints are tracked: once the limit is
+    reached, the 5% least executed are discarded, like the
+    ``pg_stat_statements`` PostgreSQL extension. The 95th percentile is
+    estimated from a uniform sample of at most ``samples`` durations of each
+    fingerprint.
+    """
+
+    def __init__(self, max_statements=1000, samples=200):
+        self.max_statements = max_statements
+        self.samples = samples
+        self.statements = {}
+        # guards the statistics from concurrent requests
+        self.lock = threading.Lock()
+        self.random = random.Random()
+
+    def add(self, route_name, statements):
+        """
+        Account the statements of a request matching ``route_name``, as
+        ``(fingerprint, durations)`` tuples with the durations in
+        milliseconds.
+        """
+        with self.lock:
+            for key, durations in statements:
+                entry = self.statements.get(key)
+                if entry is None:
+                    if len(self.statements) >= self.max_statements:
+                        self._evict()
+                    entry = self.statements[key] = {
+                        'count': 0,
+                        'total': 0.0,
+                        'max': 0.0,
+                        'samples': [],
+                        'routes': {},
+                    }
+                samples = entry['samples']
+                for duration in durations:
+                    entry['count'] += 1
+                    entry['total'] += duration
+                    entry['max'] = max(entry['max'], duration)
+                    # reservoir sampling
+                    if len(samples) < self.samples:
+                        samples.append(duration)
+                    else:
+                        i = self.random.randrange(entry['count'])
+                        if i < self.samples:
+                            samples[i] = duration
+                routes = entry['routes']
+                routes[route_name] = routes.get(route_name, 0) + len(durations)
+
+    def _evict(self):
+        statements = self.statements
+        count = max(1, len(statements) // 20)
+        least = heapq.nsmallest(
+            count, statements, key=lambda key: statements[key]['count']
+        )
+        for key in least:
+            del statements[key]
+
+    def summary(self, top):
+        """
+        Return the statistics of the ``top`` statements with the highest
+        total time.
+        """
+        with self.lock:
+            statements = heapq.nlargest(
+                top, self.statements.items(), key=lambda item: item[1]['total']
+            )
+            rows = []
+            for key, entry in statements:
+                samples = sorted(entry['samples'])
+                rows.append(
+                    {
+                        'fingerprint': key,
+                        'count': entry['count'],
+                        'total': entry['total'],
+                        'mean': entry['total'] / entry['count'],
+                        'p95': samples[int(0.95 * (len(samples) - 1))],
+                        'max': entry['max'],
+                        'routes': sorted(
+                            entry['routes'].items(), key=lambda r: -r[1]
+                        ),
+                    }
+                )
+        for row in rows:
+            row['sql'] = format_sql(row['fingerprint'])
+        return rows
+
+
+def get_query_statistics(registry):
+    """
+    Return the :class:`.QueryStatistics` of the application, to which the
+    SQLAlchemy panel adds the statements of every request.
+    """
+    return get_registry_singleton(
+        registry, 'pdtb_sqla_statistics', QueryStatistics
+    )
+
+
+class SQLAStatisticsDebugPanel(DebugPanel):
+    """
+    Global panel displaying the statements with the highest total time
+    across every request handled by the application, aggregated by
+    fingerprint, along with their number of executions, mean, 95th
+    percentile and maximum duration and the routes executing them.
+    """
+
+    name = 'sqla_statistics'
+    has_content = has_sqla
+    template = (
+        'pyramid_debugtoolbar.panels:templates/sqlalchemy_statistics.dbtmako'
+    )
+    title = _('Top SQLAlchemy Queries')
+    nav_title = _('Top Queries')
+    #: The number of statements listed.
+    top = 50
+
+    def __init__(self, request):
+        self.statistics = get_query_statistics(request.registry)
+
+    def render_vars(self, request):
+        return {'statements': self.statistics.summary(self.top)}
+
+
 class SQLAlchemyViews(object):
     def __init__(self, request):
         self.request = request
@@ -205,10 +549,27 @@ class SQLAlchemyViews(object):
         toolbar = self.request.pdtb_history.get(request_id)
         if toolbar is None:
             raise HTTPBadRequest('No history found for request.')
+        toolbar.wait()
         sqlapanel = [p for p in toolbar.panels if p.name == 'sqlalchemy'][0]
+        self.pid = getattr(sqlapanel, 'pid', None)
         query_index = int(self.request.matchdict['query_index'])
         return sqlapanel.queries[query_index]
 
+    def find_engine(self, engine_id):
+        if not engine_id:
+            raise HTTPBadRequest('No valid database engine')
+        engines = getattr(
+            self.request.registry.parent_registry, 'pdtb_sqla_engines', {}
+        )
+        engine_ref = engines.get(int(engine_id))
+        engine = engine_ref() if engine_ref is not None else None
+        if self.pid != os.getpid() or engine is None:
+            raise HTTPBadRequest(
+                'The query was recorded by another process, its database '
+                'engine is not available from this process.'
+            )
+        return engine
+
     @view_config(
         route_name='debugtoolbar.sql_select',
         renderer=(
@@ -224,11 +585,7 @@ class SQLAlchemyViews(object):
         if not stmt.lower().strip().startswith('select'):
             raise HTTPBadRequest('Not a SELECT SQL statement')
 
-        if not engine_id:
-            raise HTTPBadRequest('No valid database engine')
-
-        engines = self.request.registry.parent_registry.pdtb_sqla_engines
-        engine = engines[int(engine_id)]()
+        engine = self.find_engine(engine_id)
         with engine.connect() as conn:
             result = conn.exec_driver_sql(stmt, params)
 
@@ -251,11 +608,7 @@ class SQLAlchemyViews(object):
         engine_id = query_dict['engine_id']
         params = query_dict['parameters']
 
-        if not engine_id:
-            raise HTTPBadRequest('No valid database engine')
-
-        engines = self.request.registry.parent_registry.pdtb_sqla_engines
-        engine = engines[int(engine_id)]()
+        engine = self.find_engine(engine_id)
 
         if engine.name.startswith('sqlite'):
             query = 'EXPLAIN QUERY PLAN %s' % stmt
@@ -273,6 +626,35 @@ class SQLAlchemyViews(object):
                 'duration': float(query_dict['duration']),
             }
 
+    @view_config(
+        route_name='debugtoolbar.sql_source',
+        renderer=(
+            'pyramid_debugtoolbar.panels:templates/sqlalchemy_source.dbtmako'
+        ),
+    )
+    def sql_source(self):
+        query_dict = self.find_query()
+        frame_index = int(self.request.matchdict['frame_index'])
+        try:
+            filename, lineno, funcname = query_dict['stack'][frame_index]
+        except IndexError:
+            raise HTTPBadRequest('No such frame')
+        lines = [
+            Line(i + 1, line.rstrip('\n'))
+            for i, line in enumerate(linecache.getlines(filename))
+        ]
+        context = lines[max(lineno - 11, 0) : lineno + 10]
+        for line in context:
+            line.current = line.lineno == lineno
+        return {
+            'filename': format_fname(filename),
+            'filename_long': filename,
+            'lineno': lineno,
+            'funcname': funcname,
+            'source': SOURCE_TABLE_HTML
+            % '\n'.join(line.render() for line in context),
+        }
+
 
 def includeme(config):
     config.add_route(
@@ -283,6 +665,11 @@ def includeme(config):
         'debugtoolbar.sql_explain',
         '/{request_id}/sqlalchemy/explain/{query_index}',
     )
+    config.add_route(
+        'debugtoolbar.sql_source',
+        '/{request_id}/sqlalchemy/source/{query_index}/{frame_index}',
+    )
 
     config.add_debugtoolbar_panel(SQLADebugPanel)
+    config.add_debugtoolbar_panel(SQLAStatisticsDebugPanel, is_global=True)
     config.scan(__name__)
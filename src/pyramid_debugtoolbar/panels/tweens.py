@@ -1,14 +1,70 @@
 from pyramid.interfaces import ITweens
+import time
 
 from pyramid_debugtoolbar.panels import DebugPanel
-from pyramid_debugtoolbar.utils import STATIC_PATH
+from pyramid_debugtoolbar.utils import STATIC_PATH, get_setting
 
 _ = lambda x: x
 
+#: The name under which the handler of the router, which is wrapped by the
+#: innermost tween, is timed.
+ROUTER = 'pyramid.router'
+
+
+def _timed(name, handler, outermost=False):
+    def timed_handler(request):
+        timings = getattr(request, 'pdtb_tween_timings', None)
+        if timings is None:
+            if not outermost:
+                return handler(request)
+            timings = request.pdtb_tween_timings = []
+        start = time.perf_counter()
+        try:
+            return handler(request)
+        finally:
+            timings.append((name, time.perf_counter() - start))
+
+    return timed_handler
+
+
+class TimedTweens(object):
+    """
+    Wraps the :class:`pyramid.interfaces.ITweens` of the application such
+    that each tween of the chain records the time spent in it, as
+    ``(name, seconds)`` tuples appended to ``request.pdtb_tween_timings``
+    from the innermost to the outermost tween.
+    """
+
+    def __init__(self, tweens):
+        self.tweens = tweens
+
+    def __getattr__(self, name):
+        return getattr(self.tweens, name)
+
+    def __call__(self, handler, registry):
+        tweens = self.tweens.explicit or self.tweens.implicit()
+        handler = _timed(ROUTER, handler)
+        for i, (name, factory) in enumerate(reversed(tweens)):
+            handler = _timed(
+                name, factory(handler, registry), i == len(tweens) - 1
+            )
+        return handler
+
+
+def instrument_tweens(config):
+    """Time the tweens of the application, see :class:`.TimedTweens`."""
+    registry = config.registry
+    tweens = registry.queryUtility(ITweens)
+    if tweens is not None and not isinstance(tweens, TimedTweens):
+        registry.registerUtility(TimedTweens(tweens), ITweens)
+
 
 class TweensDebugPanel(DebugPanel):
     """
     A panel to display the tweens used by your Pyramid application.
+
+    When the ``debugtoolbar.tween_timing`` setting is enabled, the panel is
+    displayed for each request along with the time spent in each tween.
     """
 
     name = 'tweens'
@@ -16,6 +72,7 @@ class TweensDebugPanel(DebugPanel):
     template = 'pyramid_debugtoolbar.panels:templates/tweens.dbtmako'
     title = _('Tweens')
     nav_title = title
+    timings = None
 
     def __init__(self, request):
         self.tweens = request.registry.queryUtility(ITweens)
@@ -24,6 +81,8 @@ class TweensDebugPanel(DebugPanel):
             self.is_active = False
         else:
             self.populate(request)
+        # the list is created by the outermost tween
+        self.timings = getattr(request, 'pdtb_tween_timings', None)
 
     def populate(self, request):
         definition = 'Explicit'
@@ -32,13 +91,74 @@ class TweensDebugPanel(DebugPanel):
             tweens = self.tweens.implicit()
             definition = 'Implicit'
         self.data = {
-            'tweens': tweens,
+            'tweens': [name for name, factory in tweens],
             'definition': definition,
+            'timings': None,
         }
 
+    def process_deferred(self):
+        # the outer tweens have returned once the request is finished
+        if not self.timings:
+            return
+        inclusive = {}
+        for name, duration in self.timings:
+            inclusive[name] = inclusive.get(name, 0.0) + duration * 1000
+        chain = self.data['tweens'] + [ROUTER]
+        timings = []
+        for i, name in enumerate(chain):
+            if name not in inclusive:
+                continue
+            inner = chain[i + 1] if i + 1 < len(chain) else None
+            exclusive = inclusive[name] - inclusive.get(inner, 0.0)
+            timings.append((name, inclusive[name], exclusive))
+        self.data['timings'] = timings
+
+    def freeze(self):
+        self.tweens = None
+        self.timings = None
+        self.data['tweens'] = tuple(self.data.get('tweens', ()))
+        if self.data.get('timings'):
+            self.data['timings'] = tuple(self.data['timings'])
+
     def render_vars(self, request):
-        return {'static_path': request.static_url(STATIC_PATH)}
+        vars = {'static_path': request.static_url(STATIC_PATH)}
+        if self.data.get('timings'):
+            averages = _average_timings(request.pdtb_history)
+            vars['averages'] = averages
+            vars['history_requests'] = max(
+                [count for count, _, _ in averages.values()] or [0]
+            )
+        return vars
+
+
+def _average_timings(history):
+    """
+    Return the average inclusive and exclusive time of each tween across
+    the requests of the history.
+    """
+    totals = {}
+    for request_id, toolbar in history.last(len(history)):
+        pending = getattr(toolbar, 'pending', None)
+        if pending is not None and not pending.done():
+            # the panels are still processed by a background worker
+            continue
+        for panel in toolbar.panels:
+            if panel.name != 'tweens':
+                continue
+            for name, inclusive, exclusive in panel.data.get('timings') or ():
+                total = totals.setdefault(name, [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += inclusive
+                total[2] += exclusive
+    return {
+        name: (count, inclusive / count, exclusive / count)
+        for name, (count, inclusive, exclusive) in totals.items()
+    }
 
 
 def includeme(config):
-    config.add_debugtoolbar_panel(TweensDebugPanel, is_global=True)
+    timing = get_setting(config.registry.settings, 'tween_timing')
+    if timing:
+        # the timings depend on the request
+        config.inject_parent_action(instrument_tweens)
+    config.add_debugtoolbar_panel(TweensDebugPanel, is_global=not timing)
@@ -0,0 +1,256 @@
+from collections import Counter
+import sys
+import threading
+import time
+
+from pyramid_debugtoolbar.utils import format_fname
+
+
+class SamplingProfiler(object):
+    """
+    A statistical profiler recording the stack of the profiled thread at a
+    regular interval from a background thread.
+
+    Its overhead does not depend on the number of function calls, unlike
+    :mod:`cProfile`, at the cost of only estimating the time spent in each
+    function. Each sample accounts for the time elapsed since the previous
+    one, as the sampling thread may be delayed while the profiled thread
+    holds the GIL. The profiler is compatible with :class:`pstats.Stats`, in
+    which case the number of calls of a function is the number of samples it
+    appears in.
+
+    """
+
+    def __init__(self, interval=0.001):
+        #: The time between two samples, in seconds.
+        self.interval = interval
+        #: The number of samples of each stack, from the outermost to the
+        #: innermost function, as ``(filename, lineno, funcname)`` tuples.
+        self.stacks = Counter()
+        #: The time, in seconds, accounted to each stack.
+        self.times = Counter()
+
+    def runcall(self, func, *args, **kw):
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(threading.get_ident(), sys._getframe(), stop),
+            name='pyramid_debugtoolbar sampler',
+            daemon=True,
+        )
+        sampler.start()
+        try:
+            return func(*args, **kw)
+        finally:
+            stop.set()
+            sampler.join()
+
+    def _sample(self, thread_id, base_frame, stop):
+        stacks = self.stacks
+        times = self.times
+        last = time.perf_counter()
+        while not stop.wait(self.interval):
+            now = time.perf_counter()
+            elapsed = now - last
+            last = now
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            # only record the frames below runcall
+            while frame is not None and frame is not base_frame:
+                code = frame.f_code
+                stack.append(
+                    (code.co_filename, code.co_firstlineno, code.co_name)
+                )
+                frame = frame.f_back
+            if frame is not None and stack:
+                stack.reverse()
+                stack = tuple(stack)
+                stacks[stack] += 1
+                times[stack] += elapsed
+            del frame
+
+    @property
+    def samples(self):
+        return sum(self.stacks.values())
+
+    def create_stats(self):
+        """
+        Aggregate the samples into ``self.stats`` using the format of
+        :mod:`cProfile` such that they can be loaded by :class:`pstats.Stats`.
+        """
+        stats = {}
+        for stack, count in self.stacks.items():
+            elapsed = self.times[stack]
+            innermost = len(stack) - 1
+            seen = set()
+            caller = None
+            for depth, func in enumerate(stack):
+                entry = stats.get(func)
+                if entry is None:
+                    entry = stats[func] = [0, 0, 0.0, 0.0, {}]
+                # recursive calls are only accounted once in the total time
+                if func not in seen:
+                    seen.add(func)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += elapsed
+                if caller is not None:
+                    edge = entry[4].get(caller, (0, 0, 0.0, 0.0))
+                    entry[4][caller] = (
+                        edge[0] + count,
+                        edge[1] + count,
+                        edge[2] + (elapsed if depth == innermost else 0.0),
+                        edge[3] + elapsed,
+                    )
+                caller = func
+            # the innermost function is the one running
+            stats[stack[-1]][2] += elapsed
+        self.stats = {
+            func: (cc, nc, tt, ct, callers)
+            for func, (cc, nc, tt, ct, callers) in stats.items()
+        }
+
+
+def format_func(func):
+    """Return a label for a ``(filename, lineno, funcname)`` tuple."""
+    filename, lineno, funcname = func
+    if filename == '~':
+        # a builtin
+        return funcname
+    return '%s %s' % (funcname, format_fname('%s:%d' % (filename, lineno)))
+
+
+def _make_node(func):
+    return {'func': func, 'value': 0.0, 'children': {}}
+
+
+def _finish_node(node, min_value):
+    # children are sorted by name such that identical stacks are merged
+    # visually in flame graphs
+    children = [
+        _finish_node(child, min_value)
+        for child in node['children'].values()
+        if child['value'] >= min_value
+    ]
+    children.sort(key=lambda child: child['name'])
+    result = {
+        'name': format_func(node['func']) if node['func'] else 'all',
+        'value': round(node['value'] * 1000, 3),
+    }
+    if children:
+        result['children'] = children
+    return result
+
+
+def call_tree(stats, stacks=None, min_fraction=0.001, max_depth=100):
+    """
+    Return the call tree of a profile, in milliseconds, as nested
+    ``{'name': name, 'value': value, 'children': [...]}`` dictionaries.
+
+    ``stacks`` maps the stacks recorded by a :class:`.SamplingProfiler` to
+    their time and results in an exact tree. Otherwise the tree is rebuilt
+    from the caller edges of ``stats``, the stats of a :mod:`cProfile`
+    profiler, in which case the time of a function called from several
+    places is split between them in proportion to the time of each caller.
+
+    Calls accounting for less than ``min_fraction`` of the total time are
+    left out to keep the tree compact.
+
+    """
+    root = _make_node(None)
+    if stacks is not None:
+        for stack, elapsed in stacks.items():
+            node = root
+            node['value'] += elapsed
+            for func in stack[:max_depth]:
+                child = node['children'].get(func)
+                if child is None:
+                    child = node['children'][func] = _make_node(func)
+                child['value'] += elapsed
+                node = child
+        return _finish_node(root, root['value'] * min_fraction)
+
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    roots = [func for func, entry in stats.items() if not entry[4]]
+    total = sum(stats[func][3] for func in roots)
+    min_value = total * min_fraction
+
+    def expand(node, path):
+        func = node['func']
+        func_total = stats[func][3]
+        if not func_total or len(path) >= max_depth:
+            return
+        scale = node['value'] / func_total
+        for callee, elapsed in callees.get(func, ()):
+            elapsed *= scale
+            # recursive calls are already accounted by the caller
+            if callee in path or elapsed < min_value:
+                continue
+            child = node['children'].get(callee)
+            if child is None:
+                child = node['children'][callee] = _make_node(callee)
+            child['value'] += elapsed
+            expand(child, path + (callee,))
+
+    for func in roots:
+        node = root['children'][func] = _make_node(func)
+        node['value'] = stats[func][3]
+        root['value'] += node['value']
+        expand(node, (func,))
+    return _finish_node(root, min_value)
+
+
+def collapsed_stacks(tree):
+    """
+    Return the call tree as collapsed stacks, one line per stack made of
+    the names of its functions separated by semicolons followed by the time
+    spent in its innermost function, in microseconds. This is the input
+    format of the FlameGraph tools by Brendan Gregg.
+    """
+    lines = []
+
+    def walk(node, prefix):
+        name = node['name'].replace(';', ':')
+        stack = prefix + ';' + name if prefix else name
+        children = node.get('children', ())
+        own = node['value'] - sum(child['value'] for child in children)
+        if own > 0:
+            lines.append('%s %d' % (stack, round(own * 1000)))
+        for child in children:
+            walk(child, stack)
+
+    for child in tree.get('children', ()):
+        walk(child, '')
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def chrome_trace(tree):
+    """
+    Return the call tree as a Chrome trace, loadable in ``chrome://tracing``
+    or Perfetto. The calls of a function are laid out one after the other.
+    """
+    events = []
+
+    def walk(node, start):
+        events.append(
+            {
+                'name': node['name'],
+                'ph': 'X',
+                'ts': round(start * 1000, 3),
+                'dur': round(node['value'] * 1000, 3),
+                'pid': 1,
+                'tid': 1,
+            }
+        )
+        for child in node.get('children', ()):
+            walk(child, start)
+            start += child['value']
+
+    start = 0.0
+    for child in tree.get('children', ()):
+        walk(child, start)
+        start += child['value']
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
@@ -0,0 +1,75 @@
+// Render the call tree of a profiled request, fetched as JSON from the url in
+// the data-url attribute of each .pDebugFlameGraph element, as a flame graph
+// with the outermost calls at the top.
+//
+// The table of profiled functions is sorted, filtered and paginated by the
+// server, each page replacing the .pDebugFunctions element.
+var FLAMEGRAPH_ROW_HEIGHT = 18;
+
+function flamegraph_color(name) {
+  var hash = 0;
+  for (var i = 0; i < name.length; i++) {
+    hash = (hash * 31 + name.charCodeAt(i)) | 0;
+  }
+  return 'hsl(' + (20 + Math.abs(hash) % 40) + ', 90%, 65%)';
+}
+
+function render_flamegraph(container, root) {
+  var total = root.value;
+  var depth_max = 0;
+  if (!total) {
+    return;
+  }
+
+  function add(node, depth, start) {
+    var children = node.children || [];
+    var width = node.value / total * 100;
+    var title = node.name + ' - ' + node.value.toFixed(3) + ' ms (' +
+                width.toFixed(1) + '%)';
+    depth_max = Math.max(depth_max, depth);
+    $('<div class="pDebugFlameNode"></div>')
+      .css({
+        left: (start / total * 100) + '%',
+        width: width + '%',
+        top: depth * FLAMEGRAPH_ROW_HEIGHT,
+        background: flamegraph_color(node.name)
+      })
+      .attr('title', title)
+      .text(node.name)
+      .appendTo(container);
+    for (var i = 0; i < children.length; i++) {
+      add(children[i], depth + 1, start);
+      start += children[i].value;
+    }
+  }
+
+  add(root, 0, 0);
+  container.css('height', (depth_max + 1) * FLAMEGRAPH_ROW_HEIGHT);
+}
+
+function load_functions(container, url, data) {
+  $.get(url, data, function(html) {
+    container.replaceWith(html);
+  });
+}
+
+$(function() {
+  $(document).on('click', '.pDebugFunctions a', function(event) {
+    event.preventDefault();
+    load_functions($(this).closest('.pDebugFunctions'), this.href);
+  });
+
+  $(document).on('submit', '.pDebugFunctions form', function(event) {
+    var form = $(this);
+    event.preventDefault();
+    load_functions(form.closest('.pDebugFunctions'), form.attr('action'),
+                   form.serialize());
+  });
+
+  $('.pDebugFlameGraph').each(function() {
+    var container = $(this);
+    $.getJSON(container.data('url'), function(root) {
+      render_flamegraph(container, root);
+    });
+  });
+});
@@ -0,0 +1,300 @@
+from contextlib import closing
+import getpass
+import hashlib
+import os
+import pickle
+from pyramid.exceptions import ConfigurationError
+import sqlite3
+import stat
+import sys
+import tempfile
+
+from pyramid_debugtoolbar.panels import DebugPanel
+from pyramid_debugtoolbar.utils import ToolbarStorage, get_setting, resolver
+
+_ = lambda x: x
+
+
+def private_directory(path):
+    """
+    Create the directory ``path`` readable and writable by the current user
+    only, and check that an existing directory is not accessible by anyone
+    else, as the history it stores is unpickled.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise ConfigurationError('%s is not a directory' % path)
+    if hasattr(os, 'getuid'):
+        if st.st_uid != os.getuid():
+            raise ConfigurationError('%s is owned by another user' % path)
+        if st.st_mode & 0o077:
+            raise ConfigurationError(
+                '%s is accessible by other users, its permissions must be '
+                '0700' % path
+            )
+    return path
+
+
+def default_history_path():
+    """
+    Return the path of the database used by the ``sqlite`` backend when the
+    ``debugtoolbar.history_path`` setting is empty.
+
+    Each user gets a private directory in the system's temporary directory,
+    in which every application gets its own database, named after its
+    working directory and script.
+    """
+    user = os.getuid() if hasattr(os, 'getuid') else getpass.getuser()
+    directory = private_directory(
+        os.path.join(tempfile.gettempdir(), 'pyramid_debugtoolbar-%s' % user)
+    )
+    app = '%s\0%s' % (os.getcwd(), os.path.abspath(sys.argv[0] or ''))
+    digest = hashlib.sha1(app.encode('utf-8', 'replace')).hexdigest()[:16]
+    return os.path.join(directory, 'history-%s.sqlite' % digest)
+
+
+def default_namespace():
+    """
+    Return the namespace of the toolbars stored by this process, shared by
+    every worker of a server: the process group of the server on POSIX.
+    """
+    if hasattr(os, 'getpgrp'):
+        return str(os.getpgrp())
+    return ''
+
+
+def make_request_history(settings):
+    """
+    Create the request history backend configured by the
+    ``debugtoolbar.history_backend`` setting.
+
+    """
+    backend = get_setting(settings, 'history_backend', 'memory')
+    max_request_history = get_setting(settings, 'max_request_history')
+    max_history_bytes = get_setting(settings, 'max_history_bytes')
+    if backend == 'memory':
+        return ToolbarStorage(max_request_history, max_history_bytes)
+    if backend == 'sqlite':
+        path = get_setting(settings, 'history_path') or default_history_path()
+        return SQLiteToolbarStorage(
+            path, max_request_history, max_history_bytes
+        )
+    factory = resolver.maybe_resolve(backend)
+    return factory(settings)
+
+
+class UnavailablePanel(DebugPanel):
+    """
+    Stand-in for a panel whose data could not be shared with other processes.
+    """
+
+    template = None
+
+    def __init__(self, panel):
+        self.name = panel.name
+        self.title = panel.title
+        self.nav_title = panel.nav_title
+        self.has_content = panel.has_content
+        self.user_activate = panel.user_activate
+        self.is_active = panel.is_active
+
+    def render_content(self, request):
+        return _(
+            'The data recorded by this panel could not be shared between '
+            'processes. It is only available from the process that handled '
+            'the request.'
+        )
+
+
+class SharedToolbar(object):
+    """
+    A snapshot of a :class:`pyramid_debugtoolbar.toolbar.DebugToolbar` loaded
+    from a history backend shared by several processes.
+    """
+
+    def __init__(self, state):
+        self.__dict__.update(state)
+
+    def wait(self):
+        pass
+
+
+def _dump_panel(panel):
+    try:
+        return pickle.dumps(panel, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return pickle.dumps(UnavailablePanel(panel), pickle.HIGHEST_PROTOCOL)
+
+
+def dump_toolbar(toolbar):
+    """
+    Serialize a :class:`pyramid_debugtoolbar.toolbar.DebugToolbar` into bytes
+    that can be loaded in another process using :func:`.load_toolbar`.
+
+    Panels that cannot be pickled are replaced by an
+    :class:`.UnavailablePanel`. The global panels shared by every request are
+    not serialized, the process loading the toolbar uses its own.
+
+    """
+    state = toolbar.__dict__.copy()
+    for name in (
+        'request',
+        'response',
+        'traceback',
+        'json',
+        'handler_panels',
+        'beforerender_panels',
+        'response_panels',
+        'pending',
+    ):
+        state.pop(name, None)
+    state['json'] = toolbar.json
+    state['panels'] = [_dump_panel(p) for p in toolbar.panels]
+    state['global_panels'] = [
+        _dump_panel(p) for p in toolbar.request_global_panels
+    ]
+    state['shared_global_panels'] = None
+    traceback = getattr(toolbar, 'traceback', None)
+    if traceback is not None:
+        try:
+            state['traceback'] = pickle.dumps(traceback)
+        except Exception:
+            # the frames of a traceback are usually tied to this process
+            pass
+    return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+
+def load_toolbar(data):
+    """Load a toolbar previously serialized by :func:`.dump_toolbar`."""
+    state = pickle.loads(data)
+    state['panels'] = [pickle.loads(p) for p in state['panels']]
+    state['global_panels'] = [pickle.loads(p) for p in state['global_panels']]
+    if 'traceback' in state:
+        state['traceback'] = pickle.loads(state['traceback'])
+    return SharedToolbar(state)
+
+
+class SQLiteToolbarStorage(object):
+    """
+    Request history stored in a SQLite database that can be shared by every
+    process serving the application.
+
+    Toolbars are written to the database once the request is complete.
+    Toolbars created by the current process are also kept in memory such that
+    live objects, like tracebacks with their frames, remain usable from the
+    process that handled the request.
+
+    """
+
+    multiprocess = True
+
+    def __init__(self, path, max_elem, max_bytes=None, namespace=None):
+        self.path = path
+        self.max_elem = max_elem
+        if namespace is None:
+            namespace = default_namespace()
+        self.namespace = namespace
+        # toolbars created by this process
+        self.local = ToolbarStorage(max_elem, max_bytes)
+        # toolbars loaded from other processes
+        self.loaded = ToolbarStorage(max_elem)
+        # the database contains pickles, only the current user may write
+        # into it
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            st = os.fstat(fd)
+        finally:
+            os.close(fd)
+        if hasattr(os, 'getuid') and (
+            st.st_uid != os.getuid() or st.st_mode & 0o022
+        ):
+            raise ConfigurationError(
+                '%s must be owned by the current user and not be writable by '
+                'other users' % path
+            )
+        with self._connect() as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS toolbars ('
+                'namespace TEXT NOT NULL, request_id TEXT NOT NULL, '
+                'data BLOB NOT NULL, PRIMARY KEY (namespace, request_id))'
+            )
+            # the toolbars of the servers that previously used the database
+            conn.execute(
+                'DELETE FROM toolbars WHERE namespace != ?', (namespace,)
+            )
+
+    def _connect(self):
+        # connections are not shared between threads or forked processes
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute(
+                'SELECT COUNT(*) FROM toolbars WHERE namespace = ?',
+                (self.namespace,),
+            ).fetchone()[0]
+
+    @property
+    def nbytes(self):
+        return self.local.nbytes
+
+    def get(self, request_id, default=None):
+        toolbar = self.local.get(request_id)
+        if toolbar is not None:
+            return toolbar
+        toolbar = self.loaded.get(request_id)
+        if toolbar is not None:
+            return toolbar
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT data FROM toolbars '
+                'WHERE namespace = ? AND request_id = ?',
+                (self.namespace, request_id),
+            ).fetchone()
+        if row is None:
+            return default
+        try:
+            toolbar = load_toolbar(row[0])
+        except Exception:
+            # written by an incompatible version of the toolbar
+            return default
+        self.loaded.put(request_id, toolbar)
+        return toolbar
+
+    def put(self, request_id, request):
+        self.local.put(request_id, request)
+
+    def update(self, request_id, request):
+        self.local.update(request_id, request)
+        data = dump_toolbar(request)
+        with self._connect() as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO toolbars (namespace, request_id, data) '
+                'VALUES (?, ?, ?)',
+                (self.namespace, request_id, data),
+            )
+            if self.max_elem is not None:
+                conn.execute(
+                    'DELETE FROM toolbars '
+                    'WHERE namespace = ? AND rowid NOT IN ('
+                    'SELECT rowid FROM toolbars WHERE namespace = ? '
+                    'ORDER BY rowid DESC LIMIT ?)',
+                    (self.namespace, self.namespace, self.max_elem),
+                )
+
+    def last(self, num_items):
+        """Returns the last `num_items` Toolbar objects"""
+        with self._connect() as conn:
+            ids = conn.execute(
+                'SELECT request_id FROM toolbars WHERE namespace = ? '
+                'ORDER BY rowid DESC LIMIT ?',
+                (self.namespace, num_items),
+            ).fetchall()
+        result = []
+        for (request_id,) in ids:
+            toolbar = self.get(request_id)
+            if toolbar is not None:
+                result.append((request_id, toolbar))
+        return result
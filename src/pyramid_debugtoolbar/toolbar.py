@@ -1,29 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pyramid.exceptions import URLDecodeError
 from pyramid.httpexceptions import WSGIHTTPException
-from pyramid.interfaces import Interface
+from pyramid.interfaces import Interface, IRoutesMapper
 from pyramid.threadlocal import get_current_request
+import random
 import sys
+import threading
 import time
 from urllib.parse import unquote
 import warnings
 
+from pyramid_debugtoolbar.panels import DebugPanel
+from pyramid_debugtoolbar.storage import make_request_history
 from pyramid_debugtoolbar.tbtools import get_traceback
 from pyramid_debugtoolbar.utils import (
     STATIC_PATH,
-    ToolbarStorage,
-    addr_in,
+    ReplaceInsensitiveIter,
     debug_toolbar_url,
+    estimate_size,
     get_exc_name,
     get_setting,
     logger,
+    make_addr_matcher,
     make_subrequest,
     replace_insensitive,
     resolve_panel_classes,
 )
 
+_ = lambda x: x
+
 html_types = ('text/html', 'application/xhtml+xml')
 
+# the number of bytes at the end of a response searched for '</body>'
+inject_window = 64 * 1024
+
 
 class IToolbarWSGIApp(Interface):
     """Marker interface for the toolbar WSGI application."""
@@ -47,6 +58,70 @@ class IRequestAuthorization(Interface):
         """
 
 
+panel_hooks = ('wrap_handler', 'process_beforerender', 'process_response')
+
+
+def get_panel_hooks(panel_class):
+    """
+    Return the names of the lifecycle hooks overridden by a panel class.
+
+    Panel factories that are not subclasses of
+    :class:`pyramid_debugtoolbar.panels.DebugPanel` are assumed to use every
+    hook.
+
+    """
+    if not (
+        isinstance(panel_class, type) and issubclass(panel_class, DebugPanel)
+    ):
+        return frozenset(panel_hooks)
+    return frozenset(
+        name
+        for name in panel_hooks
+        if getattr(panel_class, name) is not getattr(DebugPanel, name)
+    )
+
+
+def is_shared_global_panel(panel_class):
+    """
+    Return whether a global panel can be created once and shared by every
+    request: panels that can be activated by the user or that use a
+    lifecycle hook depend on the request.
+    """
+    return not getattr(panel_class, 'user_activate', False) and not (
+        get_panel_hooks(panel_class)
+    )
+
+
+class InactivePanel(DebugPanel):
+    """
+    Stand-in for a panel that was not activated by the user and does not
+    record anything while inactive, such that there is no need to create it.
+    """
+
+    template = None
+    is_active = False
+    user_activate = True
+
+    def __init__(self, panel_class):
+        self.name = panel_class.name
+        self.title = panel_class.title
+        self.nav_title = panel_class.nav_title
+        url = getattr(panel_class, 'url', '')
+        # the url may only be known by an instance too
+        self.url = url if isinstance(url, str) else ''
+        has_content = getattr(panel_class, 'has_content', False)
+        # the content of the panel may only be known by an instance
+        self.has_content = (
+            has_content if isinstance(has_content, bool) else True
+        )
+
+    def render_content(self, request):
+        return _(
+            'This panel is not active. Activate it and reload the page to '
+            'record its data.'
+        )
+
+
 class DebugToolbar(object):
     def __init__(
         self,
@@ -54,14 +129,30 @@ class DebugToolbar(object):
         panel_classes,
         global_panel_classes,
         default_active_panels,
+        shared_global_panels=(),
+        hooks=None,
     ):
         self.panels = []
-        self.global_panels = []
+        # the panels using each lifecycle hook
+        self.handler_panels = []
+        self.beforerender_panels = []
+        self.response_panels = []
+        # global panels shared with every other request of the application
+        self.shared_global_panels = list(shared_global_panels)
+        self.global_panels = list(shared_global_panels)
         self.request = request
         self.status_int = 200
         self.default_active_panels = default_active_panels
         self.visible = False
         self.visible_at = 0
+        # the deferred processing of the panels running in the background
+        self.pending = None
+        self.summary = {
+            'host': request.host,
+            'method': request.method,
+            'path': request.path,
+            'scheme': request.scheme,
+        }
 
         # Panels can be be activated (more features) (e.g. Performance panel)
         # toolbar.js controls this cookie with the following concepts:
@@ -79,45 +170,117 @@ class DebugToolbar(object):
             elif not panel_inst.user_activate:
                 panel_inst.is_active = True
 
-        for panel_class in panel_classes:
+        if hooks is None:
+            hooks = {}
+
+        def make_panel(panel_class, is_global):
+            used_hooks = hooks.get(panel_class)
+            if used_hooks is None:
+                used_hooks = get_panel_hooks(panel_class)
+            if (
+                getattr(panel_class, 'user_activate', False)
+                and panel_class.name not in activated
+                and not (
+                    used_hooks
+                    and getattr(panel_class, 'record_inactive', True)
+                )
+            ):
+                return InactivePanel(panel_class)
             panel_inst = panel_class(request)
             configure_panel(panel_inst)
-            self.panels.append(panel_inst)
+            if 'wrap_handler' in used_hooks and not is_global:
+                self.handler_panels.append(panel_inst)
+            if 'process_beforerender' in used_hooks and not is_global:
+                self.beforerender_panels.append(panel_inst)
+            if 'process_response' in used_hooks:
+                self.response_panels.append(panel_inst)
+            return panel_inst
+
+        for panel_class in panel_classes:
+            self.panels.append(make_panel(panel_class, False))
         for panel_class in global_panel_classes:
-            panel_inst = panel_class(request)
-            configure_panel(panel_inst)
-            self.global_panels.append(panel_inst)
+            self.global_panels.append(make_panel(panel_class, True))
 
     @property
     def json(self):
-        return {
-            'host': self.request.host,
-            'method': self.request.method,
-            'path': self.request.path,
-            'scheme': self.request.scheme,
-            'status_code': self.status_int,
-        }
+        json = self.summary.copy()
+        json['status_code'] = self.status_int
+        return json
 
     def process_response(self, request, response):
         if isinstance(response, WSGIHTTPException):
             # the body of a WSGIHTTPException needs to be "prepared"
             response.prepare(request.environ)
 
-        for panel in self.panels:
-            panel.process_response(response)
-        for panel in self.global_panels:
+        for panel in self.response_panels:
             panel.process_response(response)
 
         self.response = response
         self.visible_at = time.monotonic()
         self.visible = True
 
+    @property
+    def request_global_panels(self):
+        """The global panels created for this request only."""
+        return [
+            p for p in self.global_panels if p not in self.shared_global_panels
+        ]
+
+    def process_deferred(self):
+        """
+        Invoked once the request is finished to let every panel process the
+        data it recorded, possibly in a background thread.
+        """
+        for panel in self.panels + self.request_global_panels:
+            process_deferred = getattr(panel, 'process_deferred', None)
+            if process_deferred is not None:
+                process_deferred()
+
+    def wait(self):
+        """
+        Wait for the deferred processing of the panels to complete.
+        """
+        pending = self.pending
+        if pending is not None:
+            pending.result()
+
+    def freeze(self):
+        """
+        Invoked once the request is finished to let every panel freeze the
+        data it recorded, and to stop hanging onto the request and response.
+        """
+        for panel in self.panels + self.request_global_panels:
+            freeze = getattr(panel, 'freeze', None)
+            if freeze is not None:
+                freeze()
+        self.request = None
+        self.response = None
+
+    def estimate_size(self):
+        """
+        Estimate the memory retained by the toolbar and its panels once the
+        response has been processed.
+        """
+        # the shared global panels are not retained by this toolbar alone,
+        # and the toolbar itself may be reached from the locals of the
+        # traceback of an intercepted exception
+        seen = {id(p) for p in self.shared_global_panels}
+        seen.add(id(self))
+        size = sys.getsizeof(self)
+        for panel in self.panels + self.request_global_panels:
+            panel_estimate_size = getattr(panel, 'estimate_size', None)
+            if panel_estimate_size is not None:
+                size += panel_estimate_size(seen)
+        return size + estimate_size(self.__dict__, seen)
+
     def inject(self, request, response):
         """
         Inject the debug toolbar iframe into an HTML response.
+
+        A streamed response is not buffered, the iframe is inserted while the
+        body is sent to the client.
         """
         # called in host app
-        response_html = response.body
         toolbar_url = debug_toolbar_url(request, request.pdtb_id)
         button_style = get_setting(
             request.registry.settings, 'button_style', ''
@@ -133,9 +296,22 @@ class DebugToolbar(object):
             'toolbar_url': toolbar_url,
         }
         toolbar_html = toolbar_html.encode(response.charset or 'utf-8')
-        response.body = replace_insensitive(
-            response_html, b'</body>', toolbar_html + b'</body>'
-        )
+        if isinstance(response.app_iter, (list, tuple)):
+            response.body = replace_insensitive(
+                response.body,
+                b'</body>',
+                toolbar_html + b'</body>',
+                inject_window,
+            )
+        else:
+            response.app_iter = ReplaceInsensitiveIter(
+                response.app_iter,
+                b'</body>',
+                toolbar_html + b'</body>',
+                inject_window,
+            )
+            # the length of the body is not known until it has been sent
+            response.content_length = None
 
 
 def process_traceback(info):
@@ -152,10 +328,70 @@ def beforerender_subscriber(event):
     if request is None:
         request = get_current_request()
     if getattr(request, 'debug_toolbar', None) is not None:
-        for panel in request.debug_toolbar.panels:
+        for panel in request.debug_toolbar.beforerender_panels:
             panel.process_beforerender(event)
 
 
+_global_panels_lock = threading.Lock()
+
+
+def get_shared_global_panels(registry, request):
+    """
+    Return the global panels shared by every request of the application,
+    creating them on first use from ``request``.
+
+    The instances are cached on the application registry until
+    :func:`.invalidate_global_panels` is called. Only the panels for which
+    :func:`.is_shared_global_panel` is true are shared, the others are
+    created for each request. The shared panels are frozen once created such
+    that they do not hang onto ``request``.
+
+    """
+    panels = getattr(registry, 'pdtb_global_panels', None)
+    if panels is None:
+        with _global_panels_lock:
+            panels = getattr(registry, 'pdtb_global_panels', None)
+            if panels is None:
+                panels = []
+                for panel_class in registry.pdtb_global_panel_classes:
+                    if not is_shared_global_panel(panel_class):
+                        continue
+                    panel_inst = panel_class(request)
+                    panel_inst.is_active = True
+                    freeze = getattr(panel_inst, 'freeze', None)
+                    if freeze is not None:
+                        freeze()
+                    for name, value in list(vars(panel_inst).items()):
+                        if value is request:
+                            delattr(panel_inst, name)
+                    panels.append(panel_inst)
+                registry.pdtb_global_panels = panels
+    return panels
+
+
+def invalidate_global_panels(registry):
+    """
+    Discard the global panels cached for the application such that they are
+    created again by the next request, e.g. after changing the settings or
+    routes of the application at runtime.
+    """
+    registry.pdtb_global_panels = None
+
+
+def get_panel_classes(settings, panel_map, is_global):
+    """
+    Return the classes of the panels, or of the global panels, enabled by the
+    settings among the panels registered in ``panel_map``.
+    """
+    prefix = 'global_' if is_global else ''
+    panels = list(get_setting(settings, prefix + 'panels', []))
+    if not panels:
+        # if no panels are defined then use all available panels
+        panels = [p for p, g in panel_map if g == is_global]
+    panels.extend(get_setting(settings, 'extra_' + prefix + 'panels', []))
+    return resolve_panel_classes(panels, is_global, panel_map)
+
+
 def toolbar_tween_factory(handler, registry, _logger=None, _dispatch=None):
     """Pyramid tween factory for the debug toolbar"""
     # _logger and _dispatch are passed for testing purposes only
@@ -174,40 +410,59 @@ def toolbar_tween_factory(handler, registry, _logger=None, _dispatch=None):
     toolbar_app = registry.getUtility(IToolbarWSGIApp)
     toolbar_registry = toolbar_app.registry
 
-    max_request_history = sget('max_request_history')
-    request_history = ToolbarStorage(max_request_history)
+    request_history = make_request_history(settings)
     registry.pdtb_history = request_history
+    multiprocess_history = getattr(request_history, 'multiprocess', False)
 
     panel_map = toolbar_registry.queryUtility(IPanelMap, default={})
-    resolve_panels = lambda a, b: resolve_panel_classes(a, b, panel_map)
-
-    panel_classes = list(sget('panels', []))
-    if not panel_classes:
-        # if no panels are defined then use all available panels
-        panel_classes = [p for p, g in panel_map if not g]
-    panel_classes.extend(sget('extra_panels', []))
-    panel_classes = resolve_panels(panel_classes, False)
-    global_panel_classes = list(sget('global_panels', []))
-    if not global_panel_classes:
-        # if no panels are defined then use all available global panels
-        global_panel_classes = [p for p, g in panel_map if g]
-    global_panel_classes.extend(sget('extra_global_panels', []))
-    global_panel_classes = resolve_panels(global_panel_classes, True)
+    panel_classes = get_panel_classes(settings, panel_map, False)
+    global_panel_classes = get_panel_classes(settings, panel_map, True)
+    request_global_panel_classes = [
+        p for p in global_panel_classes if not is_shared_global_panel(p)
+    ]
+    hooks = {
+        p: get_panel_hooks(p)
+        for p in panel_classes + request_global_panel_classes
+    }
+    registry.pdtb_global_panel_classes = global_panel_classes
+    invalidate_global_panels(registry)
 
     redirect_codes = (301, 302, 303, 304)
     intercept_exc = sget('intercept_exc')
     intercept_redirects = sget('intercept_redirects')
     show_on_exc_only = sget('show_on_exc_only')
-    hosts = sget('hosts')
+    addr_in_hosts = make_addr_matcher(sget('hosts', ()))
     auth_check = registry.queryUtility(IRequestAuthorization)
-    exclude_prefixes = sget('exclude_prefixes', [])
+    exclude_prefixes = tuple(sget('exclude_prefixes', []))
     registry.pdtb_token = os.urandom(5).hex()
     registry.pdtb_eval_exc = intercept_exc
 
     default_active_panels = sget('active_panels', [])
 
+    executor = None
+    background_workers = sget('background_workers', 0)
+    if background_workers:
+        executor = ThreadPoolExecutor(
+            max_workers=background_workers,
+            thread_name_prefix='pyramid_debugtoolbar',
+        )
+
+    sample_rate = sget('sample_rate', 1.0)
+    route_sample_rates = sget('route_sample_rates', {})
+
     dispatch = lambda request: _dispatch(toolbar_app, request)
 
+    def get_sample_rate(request):
+        # routing has not happened yet so find the first route whose pattern
+        # matches the path, ignoring any custom predicates
+        if route_sample_rates:
+            mapper = registry.queryUtility(IRoutesMapper)
+            if mapper is not None:
+                for route in mapper.get_routes():
+                    if route.match(request.path_info) is not None:
+                        return route_sample_rates.get(route.name, sample_rate)
+        return sample_rate
+
     def toolbar_tween(request):
         try:
             p = request.path_info
@@ -233,19 +488,24 @@ def toolbar_tween_factory(handler, registry, _logger=None, _dispatch=None):
 
         if (
             client_addr is None
-            or any(p.startswith(e) for e in exclude_prefixes)
-            or not addr_in(client_addr, hosts)
+            or p.startswith(exclude_prefixes)
+            or not addr_in_hosts(client_addr)
             or auth_check
             and not auth_check(request)
         ):
             return handler(request)
 
-        if request.environ.get('wsgi.multiprocess', False):
+        if (
+            request.environ.get('wsgi.multiprocess', False)
+            and not multiprocess_history
+        ):
             warnings.warn(
                 'pyramid_debugtoolbar has detected that the application is '
                 'being served by a forking / multiprocess web server. The '
                 'toolbar relies on global state to work and is not compatible '
-                'with this environment. The toolbar will be disabled.',
+                'with this environment unless a shared history backend is '
+                'configured with the debugtoolbar.history_backend setting. '
+                'The toolbar will be disabled.',
                 stacklevel=1,
             )
             return handler(request)
@@ -264,15 +524,45 @@ def toolbar_tween_factory(handler, registry, _logger=None, _dispatch=None):
                 request.script_name = old_script_name
                 request.path_info = old_path_info
 
-        request.pdtb_id = str(id(request)).encode('utf8').hex()
+        rate = get_sample_rate(request)
+        if rate < 1 and random.random() >= rate:
+            return handler(request)
+
+        # include the pid as the history may be shared with other processes,
+        # padded such that the ids of two processes cannot be the same
+        request.pdtb_id = (
+            ('%010d%d' % (os.getpid(), id(request))).encode('utf8').hex()
+        )
         toolbar = DebugToolbar(
-            request, panel_classes, global_panel_classes, default_active_panels
+            request,
+            panel_classes,
+            request_global_panel_classes,
+            default_active_panels,
+            get_shared_global_panels(registry, request),
+            hooks,
         )
         request.debug_toolbar = toolbar
         request_history.put(request.pdtb_id, toolbar)
 
+        pdtb_id = request.pdtb_id
+
+        def finish_toolbar():
+            toolbar.process_deferred()
+            toolbar.freeze()
+            request_history.update(pdtb_id, toolbar)
+
+        def save_toolbar(request):
+            # invoked after the finished callbacks registered by the panels
+            # such that the toolbar is complete when it is saved. Pyramid
+            # runs them before returning the response to the WSGI server,
+            # so without an executor this still adds to the request latency
+            if executor is None:
+                finish_toolbar()
+            else:
+                toolbar.pending = executor.submit(finish_toolbar)
+
         _handler = handler
-        for panel in toolbar.panels:
+        for panel in toolbar.handler_panels:
             _handler = panel.wrap_handler(_handler)
 
         try:
@@ -309,6 +599,7 @@ def toolbar_tween_factory(handler, registry, _logger=None, _dispatch=None):
                 # data exists if the request is later examined in the full
                 # toolbar view.
                 toolbar.process_response(request, response)
+                request.add_finished_callback(save_toolbar)
 
                 # Inject the button to activate the full toolbar view.
                 toolbar.inject(request, response)
@@ -324,6 +615,10 @@ def toolbar_tween_factory(handler, registry, _logger=None, _dispatch=None):
             else:
                 msg = 'Uncaught %s at %s'
                 _logger.exception(msg % (exc_name, request.url))
+                # the toolbar is already in the history, it must be frozen
+                # and saved like the others
+                toolbar.status_int = 500
+                request.add_finished_callback(save_toolbar)
             raise
 
         else:
@@ -347,6 +642,7 @@ def toolbar_tween_factory(handler, registry, _logger=None, _dispatch=None):
                         response.status_int = 200
 
             toolbar.process_response(request, response)
+            request.add_finished_callback(save_toolbar)
 
             if not show_on_exc_only and response.content_type in html_types:
                 toolbar.inject(request, response)
@@ -3,9 +3,10 @@ import itertools
 import json
 from pyramid.config import Configurator
 from pyramid.interfaces import Interface
+from pyramid.request import Request
 from pyramid.view import view_config
 
-from pyramid_debugtoolbar.toolbar import IPanelMap
+from pyramid_debugtoolbar.toolbar import IPanelMap, get_shared_global_panels
 from pyramid_debugtoolbar.utils import (
     ROOT_ROUTE_NAME,
     SETTINGS_PREFIX,
@@ -14,9 +15,12 @@ from pyramid_debugtoolbar.utils import (
 )
 
 bundled_includes = (
+    'pyramid_debugtoolbar.panels.gc',
     'pyramid_debugtoolbar.panels.headers',
     'pyramid_debugtoolbar.panels.introspection',
+    'pyramid_debugtoolbar.panels.lifecycle',
     'pyramid_debugtoolbar.panels.logger',
+    'pyramid_debugtoolbar.panels.memory',
     'pyramid_debugtoolbar.panels.performance',
     'pyramid_debugtoolbar.panels.renderings',
     'pyramid_debugtoolbar.panels.request_vars',
@@ -157,10 +161,24 @@ def request_view(request):
 
     # set a dictionary of panels that can be accessed inside
     # DebugPanel.render_content()
+    global_panels = []
     if toolbar:
         request.toolbar_panels = {
             panel.name: panel for panel in toolbar.panels
         }
+        # the panels may still be processing the request in the background
+        toolbar.wait()
+        global_panels = toolbar.global_panels
+        if toolbar.shared_global_panels is None:
+            # the toolbar was loaded from another process, the application
+            # wide panels of this process hold the same data
+            parent_registry = request.registry.parent_registry
+            parent_request = Request.blank('/')
+            parent_request.registry = parent_registry
+            global_panels = (
+                get_shared_global_panels(parent_registry, parent_request)
+                + global_panels
+            )
 
     static_path = request.static_url(STATIC_PATH)
     root_path = request.route_url(ROOT_ROUTE_NAME)
@@ -170,16 +188,21 @@ def request_view(request):
         request.registry.settings, 'max_visible_requests'
     )
     hist_toolbars = history.last(max_visible_requests)
+    max_history_bytes = get_setting(
+        request.registry.settings, 'max_history_bytes'
+    )
     return {
         'panels': toolbar.panels if toolbar else [],
         'static_path': static_path,
         'root_path': root_path,
         'button_style': button_style,
         'history': hist_toolbars,
+        'history_size': getattr(history, 'nbytes', None),
+        'max_history_bytes': max_history_bytes,
         'default_active_panels': (
             toolbar.default_active_panels if toolbar else []
         ),
-        'global_panels': toolbar.global_panels if toolbar else [],
+        'global_panels': global_panels,
         'request_id': request_id,
     }
 
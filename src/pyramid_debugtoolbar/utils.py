@@ -1,12 +1,17 @@
-from collections import deque
+from collections import OrderedDict, deque
+from functools import lru_cache
 import ipaddress
 from itertools import islice
 from logging import getLogger
 import os.path
 from pyramid.exceptions import ConfigurationError
 from pyramid.path import DottedNameResolver
+from pyramid.registry import Registry
 from pyramid.settings import asbool
 import sys
+import threading
+import types
+import weakref
 
 try:
     from pygments import highlight
@@ -27,22 +32,180 @@ EXC_ROUTE_NAME = 'debugtoolbar.exception'
 _marker = object()
 
 
-class ToolbarStorage(deque):
-    """Deque for storing Toolbar objects."""
+class ToolbarStorage(object):
+    """
+    Bounded storage for Toolbar objects indexed by request id.
+
+    Toolbars are ordered from the most to the least recently stored. Once
+    ``max_elem`` toolbars are stored, or the estimated size of the stored
+    toolbars exceeds ``max_bytes``, the oldest ones are evicted.
+
+    """
 
-    def __init__(self, max_elem):
-        super(ToolbarStorage, self).__init__([], max_elem)
+    def __init__(self, max_elem, max_bytes=None):
+        self.maxlen = max_elem
+        self.max_bytes = max_bytes
+        self._toolbars = OrderedDict()
+        self._sizes = {}
+        self._total_size = 0
+        # guards mutation and iteration from concurrent request threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._toolbars)
+
+    def __iter__(self):
+        return iter(self.last(len(self._toolbars)))
+
+    def __getitem__(self, index):
+        return self.last(index + 1)[index]
+
+    @property
+    def nbytes(self):
+        """
+        The estimated size of the stored toolbars, or ``None`` if sizes are
+        not tracked.
+        """
+        if not self.max_bytes:
+            return None
+        return self._total_size
 
     def get(self, request_id, default=None):
-        dict_ = dict(self)
-        return dict_.get(request_id, default)
+        # a single lookup is atomic, no need to acquire the lock
+        return self._toolbars.get(request_id, default)
+
+    def _evict(self):
+        toolbars = self._toolbars
+        request_id, _ = toolbars.popitem(last=False)
+        self._total_size -= self._sizes.pop(request_id, 0)
 
     def put(self, request_id, request):
-        self.appendleft((request_id, request))
+        with self._lock:
+            toolbars = self._toolbars
+            toolbars.pop(request_id, None)
+            self._total_size -= self._sizes.pop(request_id, 0)
+            toolbars[request_id] = request
+            if self.maxlen is not None:
+                while len(toolbars) > self.maxlen:
+                    self._evict()
+
+    def update(self, request_id, request):
+        """Invoked once the toolbar for ``request_id`` is complete."""
+        if not self.max_bytes:
+            return
+        size = request.estimate_size()
+        with self._lock:
+            if request_id not in self._toolbars:
+                return
+            self._total_size += size - self._sizes.get(request_id, 0)
+            self._sizes[request_id] = size
+            # never evict the most recent toolbar
+            while (
+                len(self._toolbars) > 1 and self._total_size > self.max_bytes
+            ):
+                self._evict()
 
     def last(self, num_items):
         """Returns the last `num_items` Toolbar objects"""
-        return list(islice(self, 0, num_items))
+        with self._lock:
+            return list(islice(reversed(self._toolbars.items()), num_items))
+
+
+# objects that are shared by the whole application, or are not data
+_size_ignored_types = (
+    type,
+    types.BuiltinFunctionType,
+    types.CodeType,
+    types.FunctionType,
+    types.MethodType,
+    types.ModuleType,
+    weakref.ref,
+    Registry,
+    ToolbarStorage,
+)
+_size_leaf_types = (str, bytes, bytearray, int, float, complex, bool)
+
+
+def _is_module_globals(obj):
+    name = obj.get('__name__')
+    module = sys.modules.get(name) if isinstance(name, str) else None
+    return module is not None and getattr(module, '__dict__', None) is obj
+
+
+_registry_singletons_lock = threading.Lock()
+
+
+def get_registry_singleton(registry, attr, factory):
+    """
+    Return the ``attr`` attribute of ``registry``, set to the result of
+    ``factory()`` on the first call. Concurrent first calls get the same
+    object.
+    """
+    value = getattr(registry, attr, None)
+    if value is None:
+        with _registry_singletons_lock:
+            value = getattr(registry, attr, None)
+            if value is None:
+                value = factory()
+                setattr(registry, attr, value)
+    return value
+
+
+def estimate_size(obj, seen=None):
+    """
+    Estimate the memory retained by ``obj`` and the objects it references.
+
+    Objects whose ``id`` is in ``seen`` are skipped. It is updated with every
+    object visited, allowing to share it across calls to avoid counting an
+    object twice.
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _size_ignored_types):
+            continue
+        seen.add(id(obj))
+        try:
+            size += sys.getsizeof(obj)
+        except TypeError:  # pragma: no cover
+            continue
+        if isinstance(obj, _size_leaf_types):
+            continue
+        if isinstance(obj, dict):
+            if _is_module_globals(obj):
+                # the globals of the frames of a traceback are shared
+                size -= sys.getsizeof(obj)
+                continue
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            pending.extend(obj)
+        elif isinstance(obj, types.TracebackType):
+            # only the frames of the traceback are retained by it
+            pending.append(obj.tb_frame)
+            pending.append(obj.tb_next)
+        elif isinstance(obj, types.FrameType):
+            # the callers are not followed, they belong to the server
+            pending.append(obj.f_locals)
+        else:
+            # avoid __getattr__ implementations returning arbitrary objects
+            try:
+                pending.append(object.__getattribute__(obj, '__dict__'))
+            except AttributeError:
+                pass
+            for cls in type(obj).__mro__:
+                slots = cls.__dict__.get('__slots__', ())
+                if isinstance(slots, str):
+                    slots = (slots,)
+                for name in slots:
+                    try:
+                        pending.append(object.__getattribute__(obj, name))
+                    except (AttributeError, TypeError):
+                        pass
+    return size
 
 
 def format_fname(value, _sys_path=None):
@@ -119,16 +282,69 @@ def escape(s, quote=False):
 
 
 # http://forums.devshed.com/python-programming-11/case-insensitive-string-replace-490921.html
-def replace_insensitive(string, target, replacement):
-    """Similar to string.replace() but is case insensitive."""
-    no_case = string.lower()
-    index = no_case.rfind(target.lower())
+def replace_insensitive(string, target, replacement, window=None):
+    """Similar to string.replace() but is case insensitive.
+
+    Only the last occurrence of ``target`` is replaced. If ``window`` is
+    given, the last ``window`` characters of ``string`` are searched first to
+    avoid copying the entire string when the target is near its end.
+    """
+    target = target.lower()
+    index = -1
+    if window is not None and len(string) > window:
+        start = len(string) - window
+        index = string[start:].lower().rfind(target)
+        if index >= 0:
+            index += start
+    if index < 0:
+        index = string.lower().rfind(target)
     if index >= 0:
         return string[:index] + replacement + string[index + len(target) :]
     else:  # no results so return the original string
         return string
 
 
+class ReplaceInsensitiveIter(object):
+    """
+    Wrap a WSGI ``app_iter`` and replace the last occurrence of ``target``,
+    compared case insensitively, while streaming the chunks through.
+
+    Data is held back from the last occurrence of ``target`` found in the
+    stream onwards. An occurrence followed by more than ``window`` bytes is
+    given up on, bounding the memory used by the iterator.
+
+    """
+
+    def __init__(self, app_iter, target, replacement, window):
+        self.app_iter = app_iter
+        self.target = target.lower()
+        self.replacement = replacement
+        self.window = window
+
+    def __iter__(self):
+        target = self.target
+        # the end of the pending data which may be the start of a match
+        keep = len(target) - 1
+        pending = b''
+        for chunk in self.app_iter:
+            if not chunk:
+                continue
+            pending += chunk
+            index = pending.lower().rfind(target)
+            if index < 0 or len(pending) - index > self.window:
+                index = len(pending) - keep
+            if index > 0:
+                yield pending[:index]
+                pending = pending[index:]
+        if pending:
+            yield replace_insensitive(pending, target, self.replacement)
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
 resolver = DottedNameResolver(None)
 
 
@@ -144,6 +360,48 @@ def as_int(value):
     return value
 
 
+def as_float(value):
+    if isinstance(value, str):
+        value = float(value)
+    return value
+
+
+def as_float_map(value):
+    """Convert ``name value`` pairs, one per line, into a ``dict``."""
+    if isinstance(value, dict):
+        return value
+    result = {}
+    for item in as_cr_separated_list(value):
+        pair = item.split() if isinstance(item, str) else item
+        try:
+            name, number = pair
+            result[name] = as_float(number)
+        except (TypeError, ValueError):
+            raise ValueError(
+                'expected a name followed by a number, got %r' % (item,)
+            )
+    return result
+
+
+def as_rate(value):
+    """Convert a fraction between ``0`` and ``1``."""
+    value = as_float(value)
+    if not 0 <= value <= 1:
+        raise ValueError('%r is not between 0 and 1' % (value,))
+    return value
+
+
+def as_rate_map(value):
+    """Convert ``name rate`` pairs, one per line, into a ``dict``."""
+    result = as_float_map(value)
+    for name, rate in result.items():
+        if not 0 <= rate <= 1:
+            raise ValueError(
+                'the rate of %r, %r, is not between 0 and 1' % (name, rate)
+            )
+    return result
+
+
 def as_list(value):
     values = as_cr_separated_list(value)
     result = []
@@ -202,6 +460,45 @@ def addr_in(addr, hosts):
     return False
 
 
+def make_addr_matcher(hosts, cache_size=1024):
+    """
+    Return a function testing whether an address is part of ``hosts``.
+
+    The hosts are parsed once, single addresses are looked up in a set and
+    the decision for the most recent addresses is cached. A
+    :class:`pyramid.exceptions.ConfigurationError` is raised for invalid
+    hosts.
+
+    """
+    addresses = set()
+    networks = []
+    for host in hosts:
+        try:
+            network = ipaddress.ip_network(u'' + host)
+        except ValueError as e:
+            raise ConfigurationError(
+                'Invalid value for the %shosts setting: %s'
+                % (SETTINGS_PREFIX, e)
+            )
+        if network.num_addresses == 1:
+            addresses.add(network.network_address)
+        else:
+            networks.append(network)
+    if not addresses and not networks:
+        return lambda addr: False
+    # try the largest networks first
+    networks.sort(key=lambda n: (n.version, n.prefixlen))
+
+    @lru_cache(maxsize=cache_size)
+    def match(addr):
+        addr = ipaddress.ip_address(u'' + addr.split('%')[0])
+        if addr in addresses:
+            return True
+        return any(addr in network for network in networks)
+
+    return match
+
+
 def debug_toolbar_url(request, *elements, **kw):
     return request.route_url('debugtoolbar', subpath=elements, **kw)
 
@@ -34,6 +34,8 @@ class Test_parse_settings(unittest.TestCase):
             'debugtoolbar.button_style': '',
             'debugtoolbar.max_request_history': 100,
             'debugtoolbar.max_visible_requests': 10,
+            'debugtoolbar.sample_rate': '0.5',
+            'debugtoolbar.route_sample_rates': 'home 1\napi 0.1',
         }
         result = self._callFUT(settings)
         self.assertEqual(
@@ -64,10 +66,38 @@ class Test_parse_settings(unittest.TestCase):
                 'debugtoolbar.includes': [],
                 'debugtoolbar.button_style': '',
                 'debugtoolbar.max_request_history': 100,
+                'debugtoolbar.max_history_bytes': 0,
+                'debugtoolbar.background_workers': 0,
+                'debugtoolbar.profiler': 'cprofile',
+                'debugtoolbar.profiler_interval': 1.0,
+                'debugtoolbar.tracemalloc_frames': 10,
+                'debugtoolbar.tween_timing': False,
+                'debugtoolbar.sqla_repeat_threshold': 3,
+                'debugtoolbar.sqla_stack_frames': 5,
+                'debugtoolbar.history_backend': 'memory',
+                'debugtoolbar.history_path': '',
                 'debugtoolbar.max_visible_requests': 10,
+                'debugtoolbar.sample_rate': 0.5,
+                'debugtoolbar.route_sample_rates': {'home': 1.0, 'api': 0.1},
             },
         )
 
+    def test_invalid_route_sample_rates(self):
+        from pyramid.exceptions import ConfigurationError
+
+        for value in ('home', 'home 1\napi x', 'home 1.5'):
+            settings = {'debugtoolbar.route_sample_rates': value}
+            with self.assertRaises(ConfigurationError) as cm:
+                self._callFUT(settings)
+            self.assertIn('debugtoolbar.route_sample_rates', str(cm.exception))
+        self.assertIn("'home'", str(cm.exception))
+
+    def test_invalid_sample_rate(self):
+        from pyramid.exceptions import ConfigurationError
+
+        settings = {'debugtoolbar.sample_rate': '-0.5'}
+        self.assertRaises(ConfigurationError, self._callFUT, settings)
+
 
 class Test_includeme(unittest.TestCase):
     def setUp(self):
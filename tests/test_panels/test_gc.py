@@ -0,0 +1,137 @@
+import gc
+from pyramid import testing
+from pyramid.request import Request
+import threading
+import unittest
+
+from ._utils import _TestDebugtoolbarPanel, ok_response_factory
+
+
+class TestGCPanel(_TestDebugtoolbarPanel):
+    def setUp(self):
+        super(TestGCPanel, self).setUp()
+
+        def collecting_view(request):
+            for _ in range(10):
+                cycle = []
+                cycle.append(cycle)
+            del cycle
+            gc.collect()
+            return ok_response_factory()
+
+        self.config.add_route('collect', '/collect')
+        self.config.add_view(collecting_view, route_name='collect')
+
+    def _makeToolbarResponse(self, path):
+        app = self.config.make_wsgi_app()
+        request = Request.blank(path)
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(app)
+        link = self.re_toolbar_link.findall(response.text)[0]
+        request = Request.blank(link)
+        request.remote_addr = '127.0.0.1'
+        return request.get_response(app)
+
+    def test_collection(self):
+        response = self._makeToolbarResponse('/collect')
+        self.assertIn('<h4>Collections</h4>', response.text)
+        self.assertIn('Garbage collection', response.text)
+
+    def test_no_collection(self):
+        gc.disable()
+        self.addCleanup(gc.enable)
+        response = self._makeToolbarResponse('/')
+        self.assertIn('The garbage collector is disabled.', response.text)
+        self.assertIn('No garbage collection was triggered', response.text)
+
+
+class TestCollectionTracker(unittest.TestCase):
+    def _makeOne(self):
+        from pyramid_debugtoolbar.panels.gc import CollectionTracker
+
+        return CollectionTracker()
+
+    def _collect(self, tracker, generation=1, collected=3):
+        tracker('start', {'generation': generation})
+        tracker(
+            'stop',
+            {
+                'generation': generation,
+                'collected': collected,
+                'uncollectable': 0,
+            },
+        )
+
+    def test_record(self):
+        tracker = self._makeOne()
+        self._collect(tracker)
+        collections = tracker.record()
+        self._collect(tracker, 2, 5)
+        tracker.stop()
+        self._collect(tracker)
+        self.assertEqual(len(collections), 1)
+        self.assertEqual(collections[0]['generation'], 2)
+        self.assertEqual(collections[0]['collected'], 5)
+        self.assertGreater(tracker.pause_time(), 0)
+
+    def test_threads_are_separate(self):
+        tracker = self._makeOne()
+        collections = tracker.record()
+        thread = threading.Thread(target=self._collect, args=(tracker,))
+        thread.start()
+        thread.join()
+        self.assertEqual(collections, [])
+        self.assertEqual(tracker.pause_time(), 0.0)
+
+    def test_stop_without_start(self):
+        tracker = self._makeOne()
+        tracker.record()
+        tracker('stop', {'generation': 0, 'collected': 0, 'uncollectable': 0})
+        self.assertEqual(tracker.local.collections, [])
+
+    def test_install_once(self):
+        tracker = self._makeOne()
+        self.addCleanup(gc.callbacks.remove, tracker)
+        tracker.install()
+        tracker.install()
+        self.assertEqual(gc.callbacks.count(tracker), 1)
+
+
+class Test_install_tracker(unittest.TestCase):
+    def setUp(self):
+        from pyramid_debugtoolbar.panels.gc import tracker
+
+        self.tracker = tracker
+        installed = tracker in gc.callbacks
+        if installed:
+            gc.callbacks.remove(tracker)
+
+        def restore():
+            if tracker in gc.callbacks:
+                gc.callbacks.remove(tracker)
+            if installed:
+                gc.callbacks.append(tracker)
+
+        self.addCleanup(restore)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _include(self, **settings):
+        config = testing.setUp(settings=settings)
+        config.include('pyramid_debugtoolbar')
+        return self.tracker in gc.callbacks
+
+    def test_default_panels(self):
+        self.assertTrue(self._include())
+
+    def test_performance_panel(self):
+        self.assertTrue(
+            self._include(**{'debugtoolbar.panels': 'headers performance'})
+        )
+
+    def test_disabled_panels(self):
+        self.assertFalse(self._include(**{'debugtoolbar.panels': 'headers'}))
+
+    def test_toolbar_disabled(self):
+        self.assertFalse(self._include(**{'debugtoolbar.enabled': 'false'}))
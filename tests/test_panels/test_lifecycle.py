@@ -0,0 +1,127 @@
+from pyramid import testing
+from pyramid.interfaces import IViewDerivers
+from pyramid.request import Request
+import time
+import unittest
+
+from ._utils import _TestDebugtoolbarPanel
+
+
+class TestLifecyclePanel(_TestDebugtoolbarPanel):
+    def setUp(self):
+        super(TestLifecyclePanel, self).setUp()
+
+        def slow_view(request):
+            time.sleep(0.02)
+            return {'body': 'OK'}
+
+        self.config.add_route('slow', '/slow')
+        self.config.add_view(slow_view, route_name='slow', renderer='json')
+        self.app = self.config.make_wsgi_app()
+
+    def _getToolbar(self, path):
+        request = Request.blank(path)
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(self.app)
+        self.assertEqual(response.status_int, 200)
+        return self.config.registry.pdtb_history.last(1)[0]
+
+    def _getPanel(self, path):
+        _, toolbar = self._getToolbar(path)
+        return [p for p in toolbar.panels if p.name == 'lifecycle'][0]
+
+    def test_phases(self):
+        panel = self._getPanel('/slow')
+        phases = dict((label, t) for label, t, _ in panel.data['phases'])
+        for label in (
+            'Tweens',
+            'Routing',
+            'Traversal',
+            'View lookup, security and predicates',
+            'View callable',
+            'Rendering',
+            'Response finalization',
+            'Debug toolbar and outer tweens',
+        ):
+            self.assertIn(label, phases)
+        self.assertGreaterEqual(phases['View callable'], 20)
+        events = [name for name, _ in panel.data['timeline']]
+        self.assertEqual(
+            events,
+            [
+                'start',
+                'NewRequest',
+                'BeforeTraversal',
+                'ContextFound',
+                'view',
+                'view_end',
+                'BeforeRender',
+                'render_end',
+                'end',
+                'NewResponse',
+            ],
+        )
+
+    def test_rendered(self):
+        request_id, _ = self._getToolbar('/slow')
+        request = Request.blank('/_debug_toolbar/' + request_id)
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(self.app)
+        self.assertIn('pDebugPanel-lifecycle-content', response.text)
+        self.assertIn('View callable', response.text)
+
+
+class Test_instrument_lifecycle(unittest.TestCase):
+    def tearDown(self):
+        testing.tearDown()
+
+    def _getInstrumentation(self, **settings):
+        from pyramid_debugtoolbar.panels.lifecycle import lifecycle_subscriber
+
+        config = testing.setUp(settings=settings)
+        config.include('pyramid_debugtoolbar')
+        config.commit()
+        registry = config.registry
+        subscribers = [
+            handler
+            for handler in registry.registeredHandlers()
+            # the subscribers are wrapped by Pyramid
+            if handler.handler.__wrapped__ is lifecycle_subscriber
+        ]
+        derivers = [
+            name
+            for name, _ in registry.getUtility(IViewDerivers).sorted()
+            if name.startswith('pdtb_')
+        ]
+        return subscribers, derivers
+
+    def test_default_panels(self):
+        subscribers, derivers = self._getInstrumentation()
+        self.assertTrue(subscribers)
+        self.assertEqual(
+            sorted(derivers), ['pdtb_render_timer', 'pdtb_view_timer']
+        )
+
+    def test_extra_panel(self):
+        subscribers, derivers = self._getInstrumentation(
+            **{
+                'debugtoolbar.panels': 'headers',
+                'debugtoolbar.extra_panels': 'lifecycle',
+            }
+        )
+        self.assertTrue(subscribers)
+        self.assertEqual(len(derivers), 2)
+
+    def test_disabled_panel(self):
+        subscribers, derivers = self._getInstrumentation(
+            **{'debugtoolbar.panels': 'headers request_vars'}
+        )
+        self.assertEqual(subscribers, [])
+        self.assertEqual(derivers, [])
+
+    def test_toolbar_disabled(self):
+        subscribers, derivers = self._getInstrumentation(
+            **{'debugtoolbar.enabled': 'false'}
+        )
+        self.assertEqual(subscribers, [])
+        self.assertEqual(derivers, [])
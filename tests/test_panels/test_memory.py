@@ -0,0 +1,83 @@
+from pyramid.request import Request
+import tracemalloc
+import unittest
+
+from ._utils import _TestDebugtoolbarPanel, ok_response_factory
+
+# kept alive across requests to be reported as still allocated
+leaked = []
+
+
+class TestMemoryPanel(_TestDebugtoolbarPanel):
+    def setUp(self):
+        super(TestMemoryPanel, self).setUp()
+
+        def leaky_view(request):
+            leaked.append(bytearray(int(request.params.get('size', 100000))))
+            return ok_response_factory()
+
+        self.config.add_route('leaky', '/leaky')
+        self.config.add_view(leaky_view, route_name='leaky')
+        self.addCleanup(leaked.clear)
+
+    def _makeToolbarResponse(self, path='/leaky', active=True):
+        app = self.config.make_wsgi_app()
+        request = Request.blank(path)
+        request.remote_addr = '127.0.0.1'
+        if active:
+            request.cookies['pdtb_active'] = 'memory'
+        response = request.get_response(app)
+        link = self.re_toolbar_link.findall(response.text)[0]
+        request = Request.blank(link)
+        request.remote_addr = '127.0.0.1'
+        return request.get_response(app)
+
+    def test_inactive(self):
+        response = self._makeToolbarResponse(active=False)
+        self.assertIn('This panel is not active', response.text)
+
+    def test_allocations(self):
+        response = self._makeToolbarResponse()
+        self.assertIn('Peak memory', response.text)
+        self.assertIn('Memory still allocated by line', response.text)
+        self.assertIn('Memory still allocated by traceback', response.text)
+        self.assertIn('test_memory.py', response.text)
+        self.assertNotIn('Changes since the previous request', response.text)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_compared_to_previous_request(self):
+        self._makeToolbarResponse()
+        response = self._makeToolbarResponse('/leaky?size=300000')
+        self.assertIn(
+            'Changes since the previous request for the route leaky',
+            response.text,
+        )
+        self.assertIn('+195.3 KiB', response.text)
+
+    def test_only_displayed_sites_are_kept(self):
+        from pyramid_debugtoolbar.panels.memory import MemoryDebugPanel
+
+        self._makeToolbarResponse()
+        allocations = self.config.registry.pdtb_route_allocations['leaky']
+        self.assertLessEqual(len(allocations['sites']), MemoryDebugPanel.top)
+        self.assertTrue(allocations['sites'])
+
+    def test_already_tracing(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        response = self._makeToolbarResponse()
+        self.assertIn('test_memory.py', response.text)
+        self.assertTrue(tracemalloc.is_tracing())
+
+
+class Test_format_size(unittest.TestCase):
+    def _callFUT(self, size):
+        from pyramid_debugtoolbar.panels.memory import format_size
+
+        return format_size(size)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT(10), '10 B')
+        self.assertEqual(self._callFUT(-2048), '-2.0 KiB')
+        self.assertEqual(self._callFUT(3 * 1024 * 1024), '3.0 MiB')
+        self.assertEqual(self._callFUT(5 * 1024**3), '5.0 GiB')
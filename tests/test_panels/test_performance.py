@@ -0,0 +1,358 @@
+import marshal
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+import sys
+import threading
+import time
+import unittest
+
+from ._utils import _TestDebugtoolbarPanel, ok_response_factory
+
+
+class TestPerformancePanel(_TestDebugtoolbarPanel):
+    def setUp(self):
+        super(TestPerformancePanel, self).setUp()
+
+        def slow_view(request):
+            time.sleep(0.02)
+            return ok_response_factory()
+
+        self.config.add_route('slow', '/slow')
+        self.config.add_view(slow_view, route_name='slow')
+
+    def _makeToolbarResponse(
+        self, path='/slow', suffix='', active=True, app=None
+    ):
+        if app is None:
+            app = self.config.make_wsgi_app()
+        request = Request.blank(path)
+        request.remote_addr = '127.0.0.1'
+        if active:
+            request.cookies['pdtb_active'] = 'performance'
+        response = request.get_response(app)
+        link = self.re_toolbar_link.findall(response.text)[0]
+        request = Request.blank(link + suffix)
+        request.remote_addr = '127.0.0.1'
+        return request.get_response(app)
+
+    def test_cprofile(self):
+        response = self._makeToolbarResponse()
+        self.assertIn('Times in milliseconds', response.text)
+        self.assertNotIn('Statistical profile', response.text)
+
+    def test_functions(self):
+        response = self._makeToolbarResponse()
+        self.assertIn('class="pDebugFunctions"', response.text)
+        self.assertIn('slow_view', response.text)
+        response = self._makeToolbarResponse(
+            suffix='/performance/functions?sort=tottime&limit=1'
+        )
+        self.assertIn('Functions 1 to 1 of', response.text)
+        self.assertIn('offset=1', response.text)
+        self.assertIn('sleep', response.text)
+
+    def test_functions_filter(self):
+        response = self._makeToolbarResponse(
+            suffix='/performance/functions?module=tests.test_panels'
+        )
+        self.assertIn('slow_view', response.text)
+        self.assertNotIn('sleep', response.text)
+        response = self._makeToolbarResponse(
+            suffix='/performance/functions?module=no_such_module'
+        )
+        self.assertIn('No function matches this filter.', response.text)
+
+    def test_functions_invalid_sort(self):
+        response = self._makeToolbarResponse(
+            suffix='/performance/functions?sort=foo'
+        )
+        self.assertEqual(response.status_int, 400)
+
+    def test_dump(self):
+        response = self._makeToolbarResponse()
+        self.assertIn('/performance/routes/slow/profile.prof', response.text)
+        response = self._makeToolbarResponse(
+            suffix='/performance/profile.prof'
+        )
+        self.assertEqual(response.content_type, 'application/octet-stream')
+        self.assertTrue(response.content_disposition.endswith('.prof"'))
+        stats = marshal.loads(response.body)
+        self.assertIn('slow_view', {func[2] for func in stats})
+
+    def test_route_dump(self):
+        app = self.config.make_wsgi_app()
+        self._makeToolbarResponse(app=app)
+        self._makeToolbarResponse(app=app)
+        self._makeToolbarResponse('/', app=app)
+        request = Request.blank(
+            '/_debug_toolbar/performance/routes/slow/profile.prof'
+        )
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(app)
+        self.assertEqual(
+            response.content_disposition,
+            'attachment; filename="route-slow.prof"',
+        )
+        stats = marshal.loads(response.body)
+        [info] = [
+            info for func, info in stats.items() if func[2] == 'slow_view'
+        ]
+        self.assertEqual(info[1], 2)
+        self.assertNotIn('empty_view', {func[2] for func in stats})
+
+    def test_route_dump_not_profiled(self):
+        app = self.config.make_wsgi_app()
+        self._makeToolbarResponse(active=False, app=app)
+        request = Request.blank(
+            '/_debug_toolbar/performance/routes/slow/profile.prof'
+        )
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(app)
+        self.assertEqual(response.status_int, 404)
+
+    def test_route_profiles(self):
+        app = self.config.make_wsgi_app()
+        response = self._makeToolbarResponse(active=False, app=app)
+        self.assertIn('No request has been profiled yet', response.text)
+        self._makeToolbarResponse(app=app)
+        response = self._makeToolbarResponse(app=app)
+        self.assertIn('pDebugPanel-route_profiles-content', response.text)
+        self.assertIn('2 profiled requests', response.text)
+
+    def test_flamegraph(self):
+        response = self._makeToolbarResponse()
+        self.assertIn('class="pDebugFlameGraph"', response.text)
+        response = self._makeToolbarResponse(suffix='/performance/flamegraph')
+        tree = response.json
+        self.assertEqual(tree['name'], 'all')
+        names = set()
+
+        def walk(node):
+            names.add(node['name'].split()[0])
+            for child in node.get('children', ()):
+                walk(child)
+
+        walk(tree)
+        self.assertIn('slow_view', names)
+
+    def test_collapsed(self):
+        response = self._makeToolbarResponse(suffix='/performance/collapsed')
+        self.assertEqual(response.content_type, 'text/plain')
+        self.assertTrue(response.content_disposition.startswith('attachment;'))
+        self.assertIn('slow_view', response.text)
+
+    def test_trace(self):
+        response = self._makeToolbarResponse(suffix='/performance/trace')
+        self.assertEqual(response.content_type, 'application/json')
+        names = [e['name'].split()[0] for e in response.json['traceEvents']]
+        self.assertIn('slow_view', names)
+
+    def test_flamegraph_not_profiled(self):
+        response = self._makeToolbarResponse(
+            suffix='/performance/flamegraph', active=False
+        )
+        self.assertEqual(response.status_int, 404)
+
+    def test_sampling(self):
+        self.settings['debugtoolbar.profiler'] = 'sampling'
+        self.settings['debugtoolbar.profiler_interval'] = 0.5
+        response = self._makeToolbarResponse()
+        self.assertIn('Statistical profile of', response.text)
+        self.assertIn('taken every\n    0.5 milliseconds', response.text)
+
+    def test_sampling_without_samples(self):
+        self.settings['debugtoolbar.profiler'] = 'sampling'
+        self.settings['debugtoolbar.profiler_interval'] = 10000.0
+        response = self._makeToolbarResponse('/')
+        self.assertIn('No samples were taken', response.text)
+
+
+class TestFunctionCalls(unittest.TestCase):
+    def _makeOne(self):
+        from pyramid_debugtoolbar.panels.performance import (
+            PerformanceDebugPanel,
+        )
+
+        panel = PerformanceDebugPanel.__new__(PerformanceDebugPanel)
+        panel.stats = DummyStats(
+            {
+                ('/app/a.py', 1, 'a'): (1, 1, 0.001, 0.010, {}),
+                ('/app/b.py', 1, 'b'): (2, 2, 0.006, 0.006, {}),
+                ('/lib/c.py', 1, 'c'): (1, 3, 0.003, 0.003, {}),
+            }
+        )
+        return panel
+
+    def _names(self, rows):
+        return [row['filename_long'].split('(')[1][:-1] for row in rows]
+
+    def test_sort(self):
+        panel = self._makeOne()
+        total, rows = panel.function_calls()
+        self.assertEqual(total, 3)
+        self.assertEqual(self._names(rows), ['a', 'b', 'c'])
+        _, rows = panel.function_calls(sort='tottime')
+        self.assertEqual(self._names(rows), ['b', 'c', 'a'])
+        _, rows = panel.function_calls(sort='ncalls')
+        self.assertEqual(self._names(rows), ['c', 'b', 'a'])
+        self.assertEqual(rows[0]['ncalls'], '3/1')
+
+    def test_pagination(self):
+        panel = self._makeOne()
+        total, rows = panel.function_calls(offset=1, limit=1)
+        self.assertEqual(total, 3)
+        self.assertEqual(self._names(rows), ['b'])
+
+    def test_filter(self):
+        panel = self._makeOne()
+        total, rows = panel.function_calls(module='app')
+        self.assertEqual(total, 2)
+        self.assertEqual(self._names(rows), ['a', 'b'])
+
+
+class TestRouteProfiles(unittest.TestCase):
+    def _makeOne(self):
+        from pyramid_debugtoolbar.panels.performance import RouteProfiles
+
+        return RouteProfiles()
+
+    def _makeStats(self, ncalls):
+        import pstats
+
+        stats = pstats.Stats()
+        stats.stats = {
+            ('/app/a.py', 1, 'a'): (1, 1, 0.004, 0.010, {}),
+            ('/app/b.py', 1, 'b'): (ncalls, ncalls, 0.006, 0.006, {}),
+        }
+        return stats
+
+    def test_merged_by_route(self):
+        profiles = self._makeOne()
+        profiles.add('home', self._makeStats(1), 10.0)
+        profiles.add('home', self._makeStats(3), 20.0)
+        profiles.add(None, self._makeStats(1), 5.0)
+        summary = profiles.summary(1)
+        self.assertEqual([r['route_name'] for r in summary], [None, 'home'])
+        home = summary[1]
+        self.assertEqual(home['requests'], 2)
+        self.assertEqual(home['elapsed'], 15.0)
+        [row] = home['function_calls']
+        self.assertTrue(row['filename_long'].endswith('(b)'))
+        self.assertEqual(row['calls'], 4)
+        self.assertEqual(row['tottime'], 12.0)
+
+
+class TestTimingRows(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _makeOne(self):
+        from pyramid_debugtoolbar.panels.performance import (
+            PerformanceDebugPanel,
+        )
+
+        request = Request.blank('/')
+        request.registry = self.config.registry
+        request.pdtb_id = 'abc'
+        panel = PerformanceDebugPanel(request)
+        panel.is_active = False
+        return panel, request
+
+    def test_other_threads_are_excluded(self):
+        stop = threading.Event()
+
+        def busy():
+            while not stop.is_set():
+                sum(range(1000))
+
+        def waiting_view(request):
+            time.sleep(0.1)
+            return Response()
+
+        thread = threading.Thread(target=busy)
+        thread.start()
+        try:
+            panel, request = self._makeOne()
+            panel.wrap_handler(waiting_view)(request)
+        finally:
+            stop.set()
+            thread.join()
+        panel.process_response(Response())
+        self.assertLess(panel.cpu_time, 50)
+        self.assertGreaterEqual(panel.total_time, 100)
+        rows = dict(panel.data['timing_rows'])
+        self.assertIn('Off-CPU time', rows)
+        self.assertIn('CPU utilization', rows)
+
+
+class DummyStats(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+
+@unittest.skipIf(
+    sys.version_info >= (3, 12), 'cProfile only profiles one thread at once'
+)
+class TestConcurrentProfiling(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _makeOne(self):
+        from pyramid_debugtoolbar.panels.performance import (
+            PerformanceDebugPanel,
+        )
+
+        request = Request.blank('/')
+        request.registry = self.config.registry
+        request.pdtb_id = 'abc'
+        panel = PerformanceDebugPanel(request)
+        panel.is_active = True
+        return panel, request
+
+    def test_requests_are_profiled_in_parallel(self):
+        # both views must be running at the same time to return
+        barrier = threading.Barrier(2, timeout=2)
+        responses = []
+
+        def first_view(request):
+            barrier.wait()
+            return Response()
+
+        def second_view(request):
+            barrier.wait()
+            return Response()
+
+        panels = []
+        threads = []
+        for view in (first_view, second_view):
+            panel, request = self._makeOne()
+            handler = panel.wrap_handler(view)
+            panels.append(panel)
+            threads.append(
+                threading.Thread(
+                    target=lambda h, r: responses.append(h(r)),
+                    args=(handler, request),
+                )
+            )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(responses), 2)
+
+        for panel, name, other in (
+            (panels[0], 'first_view', 'second_view'),
+            (panels[1], 'second_view', 'first_view'),
+        ):
+            panel.process_response(Response())
+            panel.process_deferred()
+            funcs = {func[2] for func in panel.stats.stats}
+            self.assertIn(name, funcs)
+            self.assertNotIn(other, funcs)
@@ -1,7 +1,9 @@
+import gc
 from pyramid import testing
 from pyramid.request import Request
 import sqlalchemy
 from sqlalchemy.sql import text as sqla_text
+import unittest
 
 from ._utils import _TestDebugtoolbarPanel, ok_response_factory
 
@@ -13,6 +15,7 @@ class _TestSQLAlchemyPanel(_TestDebugtoolbarPanel):
 
     config = None
     app = None
+    settings = None
 
     def _sqlalchemy_view(self, context, request):
         """
@@ -23,7 +26,7 @@ class _TestSQLAlchemyPanel(_TestDebugtoolbarPanel):
         raise NotImplementedError()
 
     def setUp(self):
-        self.config = config = testing.setUp()
+        self.config = config = testing.setUp(settings=self.settings)
         config.include("pyramid_debugtoolbar")
         config.add_view(self._sqlalchemy_view)
         self.app = config.make_wsgi_app()
@@ -150,6 +153,14 @@ class TestSimpleSelect(_TestSQLAlchemyPanel):
         self._check_rendered__select_null(resp)
 
 
+class TestSimpleSelectInBackground(TestSimpleSelect):
+    """
+    A simple SELECT, formatted by a background worker
+    """
+
+    settings = {"debugtoolbar.background_workers": "1"}
+
+
 class TestTransactionCommit(_TestSQLAlchemyPanel):
     """
     A simple transaction
@@ -246,3 +257,307 @@ class TestTransactionComplex(_TestSQLAlchemyPanel):
         resp = self._makeOne()
         self.assertEqual(resp.status_code, 200)
         self._check_rendered__panel(resp)
+
+
+class Test_fingerprint(unittest.TestCase):
+    def _callFUT(self, statement):
+        from pyramid_debugtoolbar.panels.sqla import fingerprint
+
+        return fingerprint(statement)
+
+    def test_literals(self):
+        self.assertEqual(
+            self._callFUT("SELECT * FROM t WHERE a = 'o''k' AND b = 12.5;"),
+            'SELECT * FROM t WHERE a = ? AND b = ?',
+        )
+
+    def test_bind_parameters(self):
+        self.assertEqual(
+            self._callFUT(
+                'SELECT * FROM t1 WHERE a = :a_1 AND b = %(b)s AND c = %s '
+                'AND d = $1 AND e::text = ?'
+            ),
+            'SELECT * FROM t1 WHERE a = ? AND b = ? AND c = ? AND d = ? '
+            'AND e::text = ?',
+        )
+
+    def test_in_lists(self):
+        self.assertEqual(
+            self._callFUT('SELECT * FROM t WHERE id IN (?, ?, ?)'),
+            self._callFUT('SELECT * FROM t WHERE id IN (?)'),
+        )
+
+    def test_comments_and_whitespace(self):
+        self.assertEqual(
+            self._callFUT('SELECT\n  a /* b */\nFROM t; -- c'),
+            'SELECT a FROM t',
+        )
+
+
+class TestNPlusOne(_TestSQLAlchemyPanel):
+    """
+    The same statement executed for each row of a previous query
+    """
+
+    def _sqlalchemy_view(self, context, request):
+        engine = sqlalchemy.create_engine("sqlite://", isolation_level=None)
+        with engine.begin() as conn:
+            conn.execute(sqla_text("SELECT 1, 2, 3, 4, 5;"))
+            for i in range(5):
+                conn.execute(sqla_text("SELECT :i;"), {'i': i})
+            conn.execute(sqla_text("SELECT NULL;"))
+            conn.execute(sqla_text("SELECT NULL;"))
+        return ok_response_factory()
+
+    def test_panel(self):
+        resp = self._makeOne()
+        self.assertEqual(resp.status_code, 200)
+        self._check_rendered__panel(resp)
+        self.assertIn('10 (1 N+1)', resp.text)
+        self.assertIn('1 potential N+1 pattern(s) found', resp.text)
+        self.assertIn('(_sqlalchemy_view)', resp.text)
+        self.assertIn('<a href="#pSqlaQuery-6">#6</a>', resp.text)
+
+    def test_repeated(self):
+        self._makeOne()
+        request_id, toolbar = self.config.registry.pdtb_history.last(1)[0]
+        panel = [p for p in toolbar.panels if p.name == 'sqlalchemy'][0]
+        repeated = [
+            (group['fingerprint'], group['count'], group['indices'])
+            for group in panel.data['repeated']
+        ]
+        self.assertEqual(
+            repeated,
+            [('SELECT ?', 5, (2, 3, 4, 5, 6)), ('SELECT NULL', 2, (7, 8))],
+        )
+        self.assertEqual(
+            [group['fingerprint'] for group in panel.data['n_plus_one']],
+            ['SELECT ?'],
+        )
+        call_sites = panel.data['n_plus_one'][0]['call_sites']
+        self.assertEqual(len(call_sites), 1)
+        file, file_long, line, func, count = call_sites[0]
+        self.assertEqual(file_long, __file__)
+        self.assertEqual(func, '_sqlalchemy_view')
+        self.assertEqual(count, 5)
+
+
+class TestQueryStatistics(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from pyramid_debugtoolbar.panels.sqla import QueryStatistics
+
+        return QueryStatistics(**kw)
+
+    def test_summary(self):
+        statistics = self._makeOne()
+        statistics.add('a', [('SELECT ?', [1.0, 3.0]), ('SELECT NULL', [5.0])])
+        statistics.add('b', [('SELECT ?', [2.0])])
+        rows = statistics.summary(1)
+        self.assertEqual(len(rows), 1)
+        row = rows[0]
+        self.assertEqual(row['fingerprint'], 'SELECT ?')
+        self.assertEqual(row['count'], 3)
+        self.assertEqual(row['total'], 6.0)
+        self.assertEqual(row['mean'], 2.0)
+        self.assertEqual(row['p95'], 2.0)
+        self.assertEqual(row['max'], 3.0)
+        self.assertEqual(row['routes'], [('a', 2), ('b', 1)])
+
+    def test_samples_are_bounded(self):
+        statistics = self._makeOne(samples=10)
+        statistics.add(None, [('SELECT ?', [float(i) for i in range(100)])])
+        (row,) = statistics.summary(10)
+        self.assertEqual(row['count'], 100)
+        self.assertEqual(row['max'], 99.0)
+        entry = statistics.statements['SELECT ?']
+        self.assertEqual(len(entry['samples']), 10)
+
+    def test_least_executed_are_evicted(self):
+        statistics = self._makeOne(max_statements=3)
+        statistics.add(None, [('a', [1.0, 1.0]), ('b', [1.0]), ('c', [1.0])])
+        statistics.add(None, [('d', [1.0])])
+        self.assertEqual(len(statistics.statements), 3)
+        self.assertIn('a', statistics.statements)
+        self.assertIn('d', statistics.statements)
+
+
+class TestStatisticsPanel(_TestSQLAlchemyPanel):
+    def _sqlalchemy_view(self, context, request):
+        engine = sqlalchemy.create_engine("sqlite://", isolation_level=None)
+        with engine.connect() as conn:
+            conn.execute(sqla_text("SELECT :i;"), {'i': 1})
+        return ok_response_factory()
+
+    def test_panel(self):
+        self._makeOne()
+        resp = self._makeOne()
+        self.assertIn('pDebugPanel-sqla_statistics-content', resp.text)
+        statistics = self.config.registry.pdtb_sqla_statistics
+        (row,) = statistics.summary(10)
+        self.assertEqual(row['fingerprint'], 'SELECT ?')
+        self.assertEqual(row['count'], 2)
+        self.assertEqual(row['routes'], [(None, 2)])
+
+
+class TestDuplicates(_TestSQLAlchemyPanel):
+    """
+    The same statement executed with the same parameters
+    """
+
+    def _sqlalchemy_view(self, context, request):
+        engine = sqlalchemy.create_engine("sqlite://", isolation_level=None)
+        with engine.connect() as conn:
+            for i in (1, 2, 1, 1):
+                conn.execute(sqla_text("SELECT :i;"), {'i': i})
+            # not JSON serializable
+            conn.exec_driver_sql("SELECT ?;", (b'\xff',))
+            conn.exec_driver_sql("SELECT ?;", (b'\xff',))
+        return ok_response_factory()
+
+    def test_panel(self):
+        resp = self._makeOne()
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('3 queries could be avoided', resp.text)
+
+    def test_duplicates(self):
+        self._makeOne()
+        request_id, toolbar = self.config.registry.pdtb_history.last(1)[0]
+        panel = [p for p in toolbar.panels if p.name == 'sqlalchemy'][0]
+        duplicates = [
+            (row['count'], row['indices'], row['parameters'])
+            for row in panel.data['duplicates']
+        ]
+        self.assertEqual(
+            duplicates, [(3, (1, 3, 4), (1,)), (2, (5, 6), (b'\xff',))]
+        )
+
+
+def _select_null(conn):
+    conn.execute(sqla_text("SELECT NULL;"))
+
+
+class TestCallStack(_TestSQLAlchemyPanel):
+    """
+    The frames of the application executing a statement
+    """
+
+    def _sqlalchemy_view(self, context, request):
+        engine = sqlalchemy.create_engine("sqlite://", isolation_level=None)
+        with engine.connect() as conn:
+            _select_null(conn)
+        return ok_response_factory()
+
+    def _query(self):
+        request_id, toolbar = self.config.registry.pdtb_history.last(1)[0]
+        panel = [p for p in toolbar.panels if p.name == 'sqlalchemy'][0]
+        return request_id, panel.queries[1]
+
+    def test_stack(self):
+        self._makeOne()
+        request_id, query = self._query()
+        self.assertEqual(len(query['stack']), 5)
+        funcnames = [funcname for filename, lineno, funcname in query['stack']]
+        self.assertEqual(funcnames[:2], ['_select_null', '_sqlalchemy_view'])
+        self.assertEqual(query['stack'][0][0], __file__)
+
+    def test_source(self):
+        resp = self._makeOne()
+        self.assertIn('(_select_null)', resp.text)
+        request_id, query = self._query()
+        req = Request.blank(
+            '/_debug_toolbar/%s/sqlalchemy/source/1/0' % request_id
+        )
+        req.remote_addr = '127.0.0.1'
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<dd>_select_null</dd>', resp.text)
+        self.assertIn(
+            '<tr class="line current">\n'
+            '  <td class=lineno>%d</td>\n'
+            '  <td>    conn.execute(sqla_text("SELECT NULL;"))</td>'
+            % query['stack'][0][1],
+            resp.text,
+        )
+
+        req = Request.blank(
+            '/_debug_toolbar/%s/sqlalchemy/source/1/5' % request_id
+        )
+        req.remote_addr = '127.0.0.1'
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_code, 400)
+
+
+class TestCallStackDisabled(TestCallStack):
+    settings = {'debugtoolbar.sqla_stack_frames': '0'}
+
+    def test_stack(self):
+        self._makeOne()
+        request_id, query = self._query()
+        self.assertEqual(query['stack'], ())
+
+    def test_source(self):
+        resp = self._makeOne()
+        self.assertNotIn('(_select_null)', resp.text)
+
+
+class TestSelectAndExplain(_TestSQLAlchemyPanel):
+    def _sqlalchemy_view(self, context, request):
+        # the views use a weak reference to the engine
+        self.engine = sqlalchemy.create_engine("sqlite://")
+        with self.engine.connect() as conn:
+            conn.execute(sqla_text("SELECT 1;"))
+        return ok_response_factory()
+
+    def _makeViewRequest(self, request_id, action):
+        req = Request.blank(
+            '/_debug_toolbar/%s/sqlalchemy/%s/1' % (request_id, action)
+        )
+        req.remote_addr = '127.0.0.1'
+        return req.get_response(self.app)
+
+    def test_local(self):
+        resp = self._makeOne()
+        self.assertIn('data-target="#SelectModal"', resp.text)
+        request_id, toolbar = self.config.registry.pdtb_history.last(1)[0]
+        for action in ('select', 'explain'):
+            resp = self._makeViewRequest(request_id, action)
+            self.assertEqual(resp.status_code, 200)
+
+    def test_waits_for_deferred_processing(self):
+        self._makeOne()
+        request_id, toolbar = self.config.registry.pdtb_history.last(1)[0]
+        toolbar.pending = DummyPending()
+        for action in ('select', 'explain'):
+            resp = self._makeViewRequest(request_id, action)
+            self.assertEqual(resp.status_code, 200)
+        self.assertEqual(toolbar.pending.calls, 2)
+
+    def test_recorded_by_another_process(self):
+        self._makeOne()
+        request_id, toolbar = self.config.registry.pdtb_history.last(1)[0]
+        panel = [p for p in toolbar.panels if p.name == 'sqlalchemy'][0]
+        panel.pid = -1
+        for action in ('select', 'explain'):
+            resp = self._makeViewRequest(request_id, action)
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn('recorded by another process', resp.text)
+        req = Request.blank('/_debug_toolbar/%s' % request_id)
+        req.remote_addr = '127.0.0.1'
+        resp = req.get_response(self.app)
+        self.assertNotIn('data-target="#SelectModal"', resp.text)
+
+    def test_engine_is_gone(self):
+        self._makeOne()
+        self.engine.dispose()
+        del self.engine
+        gc.collect()
+        request_id, toolbar = self.config.registry.pdtb_history.last(1)[0]
+        resp = self._makeViewRequest(request_id, 'select')
+        self.assertEqual(resp.status_code, 400)
+
+
+class DummyPending:
+    calls = 0
+
+    def result(self):
+        self.calls += 1
@@ -0,0 +1,83 @@
+from pyramid.request import Request
+import time
+
+from ._utils import _TestDebugtoolbarPanel
+
+
+def slow_tween_factory(handler, registry):
+    def slow_tween(request):
+        time.sleep(0.01)
+        return handler(request)
+
+    return slow_tween
+
+
+class TestTweensPanel(_TestDebugtoolbarPanel):
+    def setUp(self):
+        super(TestTweensPanel, self).setUp()
+        self.config.add_tween(
+            'tests.test_panels.test_tweens.slow_tween_factory'
+        )
+
+    def _makeApp(self, timing):
+        self.settings['debugtoolbar.tween_timing'] = timing
+        self.config.include('pyramid_debugtoolbar')
+        return self.config.make_wsgi_app()
+
+    def _getToolbar(self, app):
+        request = Request.blank('/')
+        request.remote_addr = '127.0.0.1'
+        request.get_response(app)
+        return self.config.registry.pdtb_history.last(1)[0]
+
+    def _getPanel(self, toolbar):
+        for panel in toolbar.panels:
+            if panel.name == 'tweens':
+                return panel
+
+    def test_global_by_default(self):
+        app = self._makeApp(False)
+        _, toolbar = self._getToolbar(app)
+        self.assertEqual(self._getPanel(toolbar), None)
+        self.assertIn(
+            'tweens', [panel.name for panel in toolbar.global_panels]
+        )
+
+    def test_timing(self):
+        app = self._makeApp(True)
+        self._getToolbar(app)
+        request_id, toolbar = self._getToolbar(app)
+        panel = self._getPanel(toolbar)
+        timings = {name: (i, e) for name, i, e in panel.data['timings']}
+        _, exclusive = timings[
+            'tests.test_panels.test_tweens.slow_tween_factory'
+        ]
+        self.assertGreaterEqual(exclusive, 10)
+        self.assertIn('pyramid.router', timings)
+        # the exclusive times add up to the time of the outermost tween
+        outermost = panel.data['timings'][0][1]
+        self.assertAlmostEqual(
+            sum(e for _, e in timings.values()), outermost, places=6
+        )
+
+        request = Request.blank('/_debug_toolbar/' + request_id)
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(app)
+        self.assertIn('Average exclusive time', response.text)
+        self.assertIn('the 2\nrequests of the history', response.text)
+
+    def test_average_skips_pending_requests(self):
+        from pyramid_debugtoolbar.panels.tweens import _average_timings
+
+        app = self._makeApp(True)
+        self._getToolbar(app)
+        _, toolbar = self._getToolbar(app)
+        history = self.config.registry.pdtb_history
+        self.assertEqual(_average_timings(history)['pyramid.router'][0], 2)
+        toolbar.pending = DummyPending()
+        self.assertEqual(_average_timings(history)['pyramid.router'][0], 1)
+
+
+class DummyPending:
+    def done(self):
+        return False
@@ -0,0 +1,136 @@
+import pstats
+import time
+import unittest
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def _makeOne(self, interval=0.001):
+        from pyramid_debugtoolbar.profiler import SamplingProfiler
+
+        return SamplingProfiler(interval)
+
+    def test_runcall(self):
+        profiler = self._makeOne()
+        result = profiler.runcall(_outer, 0.05)
+        self.assertEqual(result, 'done')
+        self.assertGreater(profiler.samples, 0)
+        for stack in profiler.stacks:
+            self.assertEqual(stack[0][2], '_outer')
+        self.assertIn(
+            ('_outer', '_sleep'),
+            {tuple(f[2] for f in stack) for stack in profiler.stacks},
+        )
+        self.assertAlmostEqual(sum(profiler.times.values()), 0.05, delta=0.04)
+
+    def test_runcall_exception(self):
+        profiler = self._makeOne()
+        self.assertRaises(ValueError, profiler.runcall, _raise)
+
+    def test_create_stats(self):
+        profiler = self._makeOne()
+        outer = ('a.py', 1, 'outer')
+        inner = ('a.py', 10, 'inner')
+        profiler.stacks.update({(outer,): 1, (outer, inner, inner): 3})
+        profiler.times.update({(outer,): 0.001, (outer, inner, inner): 0.003})
+        profiler.create_stats()
+        self.assertEqual(profiler.stats[outer][:4], (4, 4, 0.001, 0.004))
+        self.assertEqual(profiler.stats[outer][4], {})
+        cc, nc, tt, ct, callers = profiler.stats[inner]
+        self.assertEqual((cc, nc, tt, ct), (3, 3, 0.003, 0.003))
+        self.assertEqual(callers[outer], (3, 3, 0.0, 0.003))
+        self.assertEqual(callers[inner], (3, 3, 0.003, 0.003))
+
+    def test_pstats(self):
+        profiler = self._makeOne()
+        profiler.runcall(_outer, 0.01)
+        stats = pstats.Stats(profiler)
+        funcs = [f[2] for f in stats.sort_stats('cumulative').fcn_list]
+        self.assertEqual(funcs[0], '_outer')
+
+
+class Test_call_tree(unittest.TestCase):
+    a = ('a.py', 1, 'a')
+    b = ('a.py', 10, 'b')
+    c = ('a.py', 20, 'c')
+
+    def _callFUT(self, stats, stacks=None):
+        from pyramid_debugtoolbar.profiler import call_tree
+
+        return call_tree(stats, stacks)
+
+    def test_stacks(self):
+        a, b, c = self.a, self.b, self.c
+        tree = self._callFUT(None, {(a, b): 0.002, (a, c): 0.001, (a,): 0.001})
+        self.assertEqual(tree['value'], 4.0)
+        [node] = tree['children']
+        self.assertEqual(node['name'], 'a ./a.py:1')
+        self.assertEqual(
+            [(child['name'], child['value']) for child in node['children']],
+            [('b ./a.py:10', 2.0), ('c ./a.py:20', 1.0)],
+        )
+
+    def test_stats(self):
+        # a calls b and c, b calls c
+        a, b, c = self.a, self.b, self.c
+        stats = {
+            a: (1, 1, 0.001, 0.010, {}),
+            b: (1, 1, 0.001, 0.005, {a: (1, 1, 0.001, 0.005)}),
+            c: (
+                2,
+                2,
+                0.008,
+                0.008,
+                {a: (1, 1, 0.004, 0.004), b: (1, 1, 0.004, 0.004)},
+            ),
+        }
+        tree = self._callFUT(stats)
+        self.assertEqual(tree['value'], 10.0)
+        [node] = tree['children']
+        b_node, c_node = node['children']
+        self.assertEqual(b_node['value'], 5.0)
+        self.assertEqual(c_node['value'], 4.0)
+        self.assertEqual(b_node['children'][0]['value'], 4.0)
+
+    def test_recursion(self):
+        a = self.a
+        stats = {
+            a: (1, 2, 0.001, 0.001, {a: (1, 1, 0.0005, 0.0005)}),
+            ('~', 0, 'builtin'): (1, 1, 0.001, 0.001, {}),
+        }
+        tree = self._callFUT(stats)
+        names = sorted(child['name'] for child in tree['children'])
+        self.assertEqual(names, ['builtin'])
+
+    def test_collapsed_stacks(self):
+        from pyramid_debugtoolbar.profiler import collapsed_stacks
+
+        a, b = self.a, self.b
+        tree = self._callFUT(None, {(a, b): 0.002, (a,): 0.001})
+        self.assertEqual(
+            collapsed_stacks(tree),
+            'a ./a.py:1 1000\na ./a.py:1;b ./a.py:10 2000\n',
+        )
+
+    def test_chrome_trace(self):
+        from pyramid_debugtoolbar.profiler import chrome_trace
+
+        a, b, c = self.a, self.b, self.c
+        tree = self._callFUT(None, {(a, b): 0.002, (a, c): 0.001})
+        events = chrome_trace(tree)['traceEvents']
+        self.assertEqual(
+            [(e['name'].split()[0], e['ts'], e['dur']) for e in events],
+            [('a', 0.0, 3000.0), ('b', 0.0, 2000.0), ('c', 2000.0, 1000.0)],
+        )
+
+
+def _sleep(duration):
+    time.sleep(duration)
+
+
+def _outer(duration):
+    _sleep(duration)
+    return 'done'
+
+
+def _raise():
+    raise ValueError
@@ -0,0 +1,235 @@
+import os
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+import shutil
+import tempfile
+import unittest
+
+
+class Test_make_request_history(unittest.TestCase):
+    def _callFUT(self, settings):
+        from pyramid_debugtoolbar.storage import make_request_history
+
+        return make_request_history(settings)
+
+    def test_default(self):
+        from pyramid_debugtoolbar.utils import ToolbarStorage
+
+        history = self._callFUT({'debugtoolbar.max_request_history': 5})
+        self.assertIsInstance(history, ToolbarStorage)
+        self.assertEqual(history.maxlen, 5)
+
+    def test_sqlite(self):
+        from pyramid_debugtoolbar.storage import SQLiteToolbarStorage
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'history.sqlite')
+        history = self._callFUT(
+            {
+                'debugtoolbar.history_backend': 'sqlite',
+                'debugtoolbar.history_path': path,
+            }
+        )
+        self.assertIsInstance(history, SQLiteToolbarStorage)
+        self.assertEqual(history.path, path)
+
+    def test_sqlite_default_path(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(setattr, tempfile, 'tempdir', tempfile.tempdir)
+        tempfile.tempdir = tmpdir
+        history = self._callFUT({'debugtoolbar.history_backend': 'sqlite'})
+        directory = os.path.dirname(history.path)
+        self.assertEqual(os.path.dirname(directory), tmpdir)
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(history.path).st_mode & 0o777, 0o600)
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'POSIX only')
+    def test_sqlite_default_path_insecure(self):
+        from pyramid.exceptions import ConfigurationError
+
+        from pyramid_debugtoolbar.storage import default_history_path
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(setattr, tempfile, 'tempdir', tempfile.tempdir)
+        tempfile.tempdir = tmpdir
+        directory = os.path.dirname(default_history_path())
+        os.chmod(directory, 0o777)
+        self.assertRaises(ConfigurationError, default_history_path)
+
+    def test_dotted_name(self):
+        settings = {
+            'debugtoolbar.history_backend': 'tests.test_storage.DummyStorage'
+        }
+        history = self._callFUT(settings)
+        self.assertIsInstance(history, DummyStorage)
+        self.assertTrue(history.settings is settings)
+
+
+class TestSQLiteToolbarStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'history.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, max_elem=10, namespace=None):
+        from pyramid_debugtoolbar.storage import SQLiteToolbarStorage
+
+        return SQLiteToolbarStorage(self.path, max_elem, namespace=namespace)
+
+    def _makeToolbar(self, panel_classes=()):
+        from pyramid_debugtoolbar.toolbar import DebugToolbar
+
+        request = Request.blank('/foo')
+        toolbar = DebugToolbar(request, panel_classes, [], [])
+        toolbar.visible = True
+        toolbar.visible_at = 1.0
+        return toolbar
+
+    def test_local_toolbar_is_available_before_update(self):
+        history = self._makeOne()
+        toolbar = self._makeToolbar()
+        history.put('a', toolbar)
+        self.assertTrue(history.get('a') is toolbar)
+        self.assertEqual(len(history), 0)
+        self.assertEqual(history.last(1), [])
+
+    def test_shared_between_instances(self):
+        history = self._makeOne()
+        toolbar = self._makeToolbar([DummyPanel])
+        toolbar.panels[0].data = {'foo': 'bar'}
+        history.put('a', toolbar)
+        history.update('a', toolbar)
+
+        other = self._makeOne()
+        self.assertEqual(len(other), 1)
+        shared = other.get('a')
+        self.assertFalse(shared is toolbar)
+        self.assertEqual(shared.json['path'], '/foo')
+        self.assertEqual(shared.visible_at, 1.0)
+        self.assertEqual(shared.panels[0].data, {'foo': 'bar'})
+        self.assertEqual(other.last(1), [('a', shared)])
+
+    def test_unpicklable_panel_is_replaced(self):
+        from pyramid_debugtoolbar.storage import UnavailablePanel
+
+        history = self._makeOne()
+        toolbar = self._makeToolbar([DummyPanel])
+        toolbar.panels[0].data = {'foo': lambda: None}
+        history.update('a', toolbar)
+
+        shared = self._makeOne().get('a')
+        panel = shared.panels[0]
+        self.assertIsInstance(panel, UnavailablePanel)
+        self.assertEqual(panel.name, 'dummy')
+        self.assertIn('could not be shared', panel.render_content(None))
+
+    def test_shared_global_panels_are_not_stored(self):
+        from pyramid_debugtoolbar.toolbar import DebugToolbar
+
+        request = Request.blank('/foo')
+        shared = DummyPanel(request)
+        toolbar = DebugToolbar(request, [], [DummyPanel], [], [shared])
+        history = self._makeOne()
+        history.update('a', toolbar)
+
+        loaded = self._makeOne().get('a')
+        self.assertEqual(len(loaded.global_panels), 1)
+        self.assertFalse(loaded.global_panels[0] is shared)
+        self.assertEqual(loaded.shared_global_panels, None)
+
+    def test_max_elem(self):
+        history = self._makeOne(max_elem=2)
+        for request_id in ('a', 'b', 'c'):
+            history.update(request_id, self._makeToolbar())
+        other = self._makeOne(max_elem=2)
+        self.assertEqual([i for i, _ in other.last(10)], ['c', 'b'])
+        self.assertEqual(other.get('a'), None)
+
+    def test_previous_servers_are_cleared(self):
+        history = self._makeOne(namespace='a')
+        history.update('a', self._makeToolbar())
+        self.assertEqual(len(self._makeOne(namespace='a')), 1)
+        other = self._makeOne(namespace='b')
+        self.assertEqual(len(other), 0)
+        self.assertEqual(other.get('a'), None)
+        self.assertEqual(len(self._makeOne(namespace='a')), 0)
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'POSIX only')
+    def test_writable_by_others(self):
+        from pyramid.exceptions import ConfigurationError
+
+        self._makeOne()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        os.chmod(self.path, 0o666)
+        self.assertRaises(ConfigurationError, self._makeOne)
+
+
+class TestSQLiteIntegration(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = testing.setUp()
+        settings = self.config.registry.settings
+        settings['debugtoolbar.history_backend'] = 'sqlite'
+        settings['debugtoolbar.history_path'] = os.path.join(
+            self.tmpdir, 'history.sqlite'
+        )
+        self.config.include('pyramid_debugtoolbar')
+        self.config.add_view(
+            lambda r: Response('<html><body>OK</body></html>')
+        )
+
+    def tearDown(self):
+        testing.tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_multiprocess_server(self):
+        from pyramid_debugtoolbar.storage import (
+            SQLiteToolbarStorage,
+            UnavailablePanel,
+        )
+
+        app = self.config.make_wsgi_app()
+        request = Request.blank('/', environ={'wsgi.multiprocess': True})
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(app)
+        self.assertIn(b'pDebugToolbarHandle', response.body)
+
+        path = self.config.registry.settings['debugtoolbar.history_path']
+        other = SQLiteToolbarStorage(path, 10)
+        entries = other.last(10)
+        self.assertEqual(len(entries), 1)
+        toolbar = entries[0][1]
+        self.assertEqual(toolbar.json['path'], '/')
+        # every bundled panel is frozen into data that can be pickled
+        for panel in toolbar.panels:
+            self.assertNotIsInstance(panel, UnavailablePanel)
+
+        # render the toolbar from the shared history only
+        self.config.registry.pdtb_history = other
+        request = Request.blank('/_debug_toolbar/' + entries[0][0])
+        request.remote_addr = '127.0.0.1'
+        response = request.get_response(app)
+        self.assertEqual(response.status_int, 200)
+        self.assertIn(b'pDebugPanel-versions-content', response.body)
+
+
+class DummyStorage:
+    def __init__(self, settings):
+        self.settings = settings
+
+
+class DummyPanel:
+    name = 'dummy'
+    title = nav_title = 'Dummy'
+    has_content = True
+    user_activate = False
+    is_active = True
+
+    def __init__(self, request):
+        self.data = {}
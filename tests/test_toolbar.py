@@ -1,3 +1,4 @@
+import os
 from pyramid import testing
 from pyramid.request import Request
 from pyramid.response import Response
@@ -5,6 +6,8 @@ import unittest
 import warnings
 from webtest import TestApp
 
+from pyramid_debugtoolbar.panels import DebugPanel
+
 
 class TestDebugToolbar(unittest.TestCase):
     def setUp(self):
@@ -21,11 +24,16 @@ class TestDebugToolbar(unittest.TestCase):
         panel_classes,
         global_panel_classes,
         default_active_panels,
+        shared_global_panels=(),
     ):
         from pyramid_debugtoolbar.toolbar import DebugToolbar
 
         return DebugToolbar(
-            request, panel_classes, global_panel_classes, default_active_panels
+            request,
+            panel_classes,
+            global_panel_classes,
+            default_active_panels,
+            shared_global_panels,
         )
 
     def test_ctor_panel_is_up(self):
@@ -56,6 +64,100 @@ class TestDebugToolbar(unittest.TestCase):
         toolbar.process_response(request, response)
         self.assertTrue(response.processed)
 
+    def test_estimate_size(self):
+        request = Request.blank('/')
+        toolbar = self._makeOne(request, [DummyPanel], [], [])
+        toolbar.panels[0].blob = b'x' * 100000
+        toolbar.response = Response(b'y' * 100000)
+        self.assertGreater(toolbar.estimate_size(), 200000)
+
+    def test_freeze(self):
+        request = Request.blank('/')
+        toolbar = self._makeOne(request, [DummyPanel], [DummyPanel], [])
+        toolbar.process_response(request, Response())
+        toolbar.freeze()
+        self.assertTrue(toolbar.panels[0].frozen)
+        self.assertTrue(toolbar.global_panels[0].frozen)
+        self.assertEqual(toolbar.request, None)
+        self.assertEqual(toolbar.response, None)
+        self.assertEqual(toolbar.json['path'], '/')
+
+    def test_shared_global_panels(self):
+        request = Request.blank('/')
+        shared = DummyPanelWithContent(request)
+        toolbar = self._makeOne(
+            request, [], [DummyPanelWithContent], [], [shared]
+        )
+        self.assertEqual(len(toolbar.global_panels), 2)
+        self.assertTrue(toolbar.global_panels[0] is shared)
+        self.assertEqual(toolbar.request_global_panels[0].request, request)
+        toolbar.process_response(request, Response())
+        toolbar.freeze()
+        self.assertFalse(hasattr(shared, 'frozen'))
+        self.assertTrue(toolbar.global_panels[1].frozen)
+
+    def test_ctor_dispatches_hooks_to_overriding_panels(self):
+        request = Request.blank('/')
+        toolbar = self._makeOne(
+            request, [DummyPanel, DummyResponsePanel], [], []
+        )
+        self.assertEqual(len(toolbar.handler_panels), 1)
+        self.assertEqual(toolbar.response_panels, toolbar.panels)
+        response = Response()
+        toolbar.process_response(request, response)
+        self.assertEqual(response.processed_by, 'response')
+
+    def test_ctor_inactive_hook_free_panel_is_not_created(self):
+        from pyramid_debugtoolbar.toolbar import InactivePanel
+
+        request = Request.blank('/')
+        toolbar = self._makeOne(request, [DummyHookFreePanel], [], [])
+        panel = toolbar.panels[0]
+        self.assertIsInstance(panel, InactivePanel)
+        self.assertEqual(panel.name, 'hook_free')
+        self.assertFalse(panel.is_active)
+        self.assertTrue(panel.has_content)
+        self.assertIn('not active', panel.render_content(request))
+        self.assertEqual(panel.url, '')
+
+    def test_ctor_inactive_panel_keeps_url(self):
+        class DummyURLPanel(DummyHookFreePanel):
+            url = 'http://example.com/panel'
+
+        request = Request.blank('/')
+        toolbar = self._makeOne(request, [DummyURLPanel], [], [])
+        self.assertEqual(toolbar.panels[0].url, 'http://example.com/panel')
+
+    def test_ctor_inactive_panel_not_recording_is_not_created(self):
+        from pyramid_debugtoolbar.toolbar import InactivePanel
+
+        request = Request.blank('/')
+        toolbar = self._makeOne(
+            request, [DummyUserPanel, DummyNotRecordingPanel], [], []
+        )
+        self.assertIsInstance(toolbar.panels[0], DummyUserPanel)
+        self.assertIsInstance(toolbar.panels[1], InactivePanel)
+        self.assertEqual(toolbar.handler_panels, toolbar.panels[:1])
+
+    def test_ctor_activated_panel_not_recording_is_created(self):
+        request = Request.blank('/')
+        toolbar = self._makeOne(
+            request, [DummyNotRecordingPanel], [], ['not_recording']
+        )
+        panel = toolbar.panels[0]
+        self.assertIsInstance(panel, DummyNotRecordingPanel)
+        self.assertTrue(panel.is_active)
+        self.assertEqual(toolbar.handler_panels, [panel])
+
+    def test_ctor_activated_hook_free_panel_is_created(self):
+        request = Request.blank('/')
+        toolbar = self._makeOne(
+            request, [DummyHookFreePanel], [], ['hook_free']
+        )
+        panel = toolbar.panels[0]
+        self.assertIsInstance(panel, DummyHookFreePanel)
+        self.assertTrue(panel.is_active)
+
     def test_inject_html(self):
         from pyramid_debugtoolbar.utils import STATIC_PATH
 
@@ -71,6 +173,27 @@ class TestDebugToolbar(unittest.TestCase):
         self.assertTrue(b'div id="pDebug"' in response.app_iter[0])
         self.assertEqual(response.content_length, len(response.app_iter[0]))
 
+    def test_inject_streamed_html(self):
+        from pyramid_debugtoolbar.utils import STATIC_PATH
+
+        self.config.add_static_view('_debugtoolbar/static', STATIC_PATH)
+        self.config.add_route('debugtoolbar', '/_debugtoolbar/*subpath')
+        response = Response(
+            app_iter=iter([b'<body>', b'OK', b'</body>']),
+            content_type='text/html',
+            content_length=16,
+        )
+        request = Request.blank('/')
+        request.pdtb_id = 'abc'
+        request.registry = self.config.registry
+        toolbar = self._makeOne(request, [DummyPanel], [DummyPanel], [])
+        toolbar.inject(request, response)
+        self.assertEqual(response.content_length, None)
+        body = b''.join(response.app_iter)
+        self.assertTrue(body.startswith(b'<body>OK<'))
+        self.assertTrue(b'div id="pDebug"' in body)
+        self.assertTrue(body.endswith(b'</body>'))
+
     def test_passing_of_button_style(self):
         from pyramid_debugtoolbar.utils import STATIC_PATH
 
@@ -309,6 +432,108 @@ class Test_toolbar_handler(unittest.TestCase):
         result = self._callFUT(request)
         self.assertFalse(getattr(result, 'processed', False))
 
+    def test_it_shares_global_panels(self):
+        from pyramid_debugtoolbar.toolbar import (
+            invalidate_global_panels,
+            toolbar_tween_factory,
+        )
+
+        registry = self.config.registry
+        registry.settings['debugtoolbar.panels'] = [DummyPanel]
+        registry.settings['debugtoolbar.global_panels'] = [
+            DummyGlobalPanel,
+            DummyUserPanel,
+            DummyPanel,
+        ]
+        tween = toolbar_tween_factory(self._makeHandler(), registry)
+        toolbars = []
+        for i in range(3):
+            if i == 2:
+                invalidate_global_panels(registry)
+            request = Request.blank('/')
+            request.remote_addr = '127.0.0.1'
+            request.registry = registry
+            tween(request)
+            toolbars.append(registry.pdtb_history.get(request.pdtb_id))
+        first, second, third = [t.global_panels for t in toolbars]
+        self.assertTrue(first[0] is second[0])
+        self.assertFalse(first[1] is second[1])
+        self.assertFalse(first[2] is second[2])
+        self.assertTrue(first[0].is_active)
+        # frozen once created, without a reference to the first request
+        self.assertEqual(first[0].calls, ['init', 'freeze'])
+        self.assertFalse(hasattr(first[0], 'request'))
+        self.assertFalse(first[0] is third[0])
+
+    def test_it_global_panels_process_response(self):
+        registry = self.config.registry
+        registry.settings['debugtoolbar.panels'] = []
+        registry.settings['debugtoolbar.global_panels'] = [
+            DummyGlobalResponsePanel
+        ]
+        for i in range(3):
+            request = Request.blank('/')
+            request.remote_addr = '127.0.0.1'
+            request.registry = registry
+            self._callFUT(request)
+            (panel,) = registry.pdtb_history.get(request.pdtb_id).global_panels
+            self.assertEqual(panel.calls, ['init', 'process_response'])
+
+    def test_it_background_workers(self):
+        registry = self.config.registry
+        registry.settings['debugtoolbar.panels'] = [DummyPanel]
+        registry.settings['debugtoolbar.background_workers'] = 1
+        request = Request.blank('/')
+        request.remote_addr = '127.0.0.1'
+        request.registry = registry
+        self._callFUT(request)
+        toolbar = registry.pdtb_history.get(request.pdtb_id)
+        self.assertEqual(toolbar.pending, None)
+        request._process_finished_callbacks()
+        self.assertNotEqual(toolbar.pending, None)
+        toolbar.wait()
+        self.assertTrue(toolbar.panels[0].deferred)
+        self.assertTrue(toolbar.panels[0].frozen)
+        self.assertEqual(toolbar.request, None)
+
+    def test_it_pdtb_id_includes_padded_pid(self):
+        self.config.registry.settings['debugtoolbar.panels'] = [DummyPanel]
+        request = Request.blank('/')
+        request.remote_addr = '127.0.0.1'
+        request.registry = self.config.registry
+        self._callFUT(request)
+        request_id = bytes.fromhex(request.pdtb_id).decode('utf8')
+        self.assertEqual(request_id[:10], '%010d' % os.getpid())
+        self.assertEqual(request_id[10:], str(id(request)))
+
+    def test_it_sample_rate_zero(self):
+        self.config.registry.settings['debugtoolbar.sample_rate'] = 0.0
+        self.config.registry.settings['debugtoolbar.panels'] = [DummyPanel]
+        request = Request.blank('/')
+        request.registry = self.config.registry
+        request.remote_addr = '127.0.0.1'
+        result = self._callFUT(request)
+        self.assertFalse(hasattr(request, 'pdtb_id'))
+        self.assertFalse(getattr(result, 'processed', False))
+
+    def test_it_route_sample_rates(self):
+        settings = self.config.registry.settings
+        settings['debugtoolbar.sample_rate'] = 0.0
+        settings['debugtoolbar.route_sample_rates'] = {'sampled': 1.0}
+        settings['debugtoolbar.panels'] = [DummyPanel]
+        self.config.add_route('sampled', '/sampled/{id}')
+        self.config.add_route('other', '/other')
+        request = Request.blank('/sampled/1')
+        request.registry = self.config.registry
+        request.remote_addr = '127.0.0.1'
+        result = self._callFUT(request)
+        self.assertTrue(getattr(result, 'processed', False))
+        request = Request.blank('/other')
+        request.registry = self.config.registry
+        request.remote_addr = '127.0.0.1'
+        result = self._callFUT(request)
+        self.assertFalse(getattr(result, 'processed', False))
+
     def test_it_calls_wrap_handler(self):
         handler = self._makeHandler()
         request = Request.blank('/')
@@ -328,6 +553,7 @@ class Test_toolbar_handler(unittest.TestCase):
         def handler(request):
             raise NotImplementedError
 
+        self.config.registry.settings['debugtoolbar.panels'] = [DummyPanel]
         request.registry = self.config.registry
         logger = DummyLogger()
         self.assertRaises(
@@ -337,6 +563,11 @@ class Test_toolbar_handler(unittest.TestCase):
             handler,
             _logger=logger,
         )
+        toolbar = self.config.registry.pdtb_history.get(request.pdtb_id)
+        self.assertEqual(toolbar.status_int, 500)
+        request._process_finished_callbacks()
+        self.assertTrue(toolbar.panels[0].frozen)
+        self.assertEqual(toolbar.request, None)
 
     def test_it_raises_exception_intercept_exc(self):
         request = Request.blank('/')
@@ -584,14 +815,66 @@ class DummyPanel:
         event['processed'] = True
         self.event = event.copy()
 
+    def process_deferred(self):
+        self.deferred = not hasattr(self, 'frozen')
+
+    def freeze(self):
+        self.frozen = True
+
 
 class DummyPanelWithContent(DummyPanel):
     has_content = True
 
 
+class DummyResponsePanel(DebugPanel):
+    name = 'response'
+
+    def process_response(self, response):
+        response.processed_by = self.name
+
+
+class DummyHookFreePanel(DebugPanel):
+    name = 'hook_free'
+    has_content = True
+    user_activate = True
+    title = nav_title = 'Hook free'
+
+
+class DummyGlobalPanel(DebugPanel):
+    name = 'global'
+    has_content = True
+    title = nav_title = 'Global'
+
+    def __init__(self, request):
+        self.request = request
+        self.calls = ['init']
+
+    def freeze(self):
+        self.calls.append('freeze')
+
+
+class DummyGlobalResponsePanel(DummyGlobalPanel):
+    def process_response(self, response):
+        self.calls.append('process_response')
+
+    def freeze(self):
+        pass
+
+
+class DummyUserPanel(DummyPanel):
+    user_activate = True
+
+
+class DummyNotRecordingPanel(DummyPanelWithContent):
+    name = 'not_recording'
+    title = 'Not recording'
+    user_activate = True
+    record_inactive = False
+
+
 class DummyToolbar:
     def __init__(self, panels):
-        self.panels = panels
+        self.panels = self.beforerender_panels = panels
 
 
 class DummyLogger:
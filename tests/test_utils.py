@@ -1,7 +1,97 @@
 import os
+import sys
+import threading
 import unittest
 
 
+class TestToolbarStorage(unittest.TestCase):
+    def _makeOne(self, max_elem):
+        from pyramid_debugtoolbar.utils import ToolbarStorage
+
+        return ToolbarStorage(max_elem)
+
+    def test_get(self):
+        storage = self._makeOne(10)
+        storage.put('a', 1)
+        storage.put('b', 2)
+        self.assertEqual(storage.get('a'), 1)
+        self.assertEqual(storage.get('b'), 2)
+        self.assertEqual(storage.get('c'), None)
+        self.assertEqual(storage.get('c', 3), 3)
+
+    def test_last(self):
+        storage = self._makeOne(10)
+        for i, request_id in enumerate('abc'):
+            storage.put(request_id, i)
+        self.assertEqual(storage.last(2), [('c', 2), ('b', 1)])
+        self.assertEqual(list(storage), [('c', 2), ('b', 1), ('a', 0)])
+        self.assertEqual(storage[0], ('c', 2))
+        self.assertEqual(len(storage), 3)
+
+    def test_evicts_oldest(self):
+        storage = self._makeOne(2)
+        for i, request_id in enumerate('abc'):
+            storage.put(request_id, i)
+        self.assertEqual(storage.get('a'), None)
+        self.assertEqual(storage.last(10), [('c', 2), ('b', 1)])
+
+    def test_put_existing_id(self):
+        storage = self._makeOne(10)
+        storage.put('a', 1)
+        storage.put('b', 2)
+        storage.put('a', 3)
+        self.assertEqual(storage.last(10), [('a', 3), ('b', 2)])
+
+    def test_max_bytes(self):
+        from pyramid_debugtoolbar.utils import ToolbarStorage
+
+        storage = ToolbarStorage(10, max_bytes=100)
+        self.assertEqual(storage.nbytes, 0)
+        for request_id in 'abc':
+            toolbar = DummyToolbar(40)
+            storage.put(request_id, toolbar)
+            storage.update(request_id, toolbar)
+        self.assertEqual(storage.nbytes, 80)
+        self.assertEqual([i for i, _ in storage.last(10)], ['c', 'b'])
+
+    def test_max_bytes_keeps_most_recent(self):
+        from pyramid_debugtoolbar.utils import ToolbarStorage
+
+        storage = ToolbarStorage(10, max_bytes=100)
+        storage.put('a', DummyToolbar(10))
+        storage.update('a', storage.get('a'))
+        storage.put('b', DummyToolbar(500))
+        storage.update('b', storage.get('b'))
+        self.assertEqual([i for i, _ in storage.last(10)], ['b'])
+        self.assertEqual(storage.nbytes, 500)
+
+    def test_max_bytes_disabled(self):
+        storage = self._makeOne(10)
+        storage.put('a', None)
+        storage.update('a', None)
+        self.assertEqual(storage.nbytes, None)
+
+    def test_concurrent_put_and_last(self):
+        storage = self._makeOne(50)
+        errors = []
+
+        def writer(prefix):
+            try:
+                for i in range(2000):
+                    storage.put('%s%d' % (prefix, i), i)
+                    storage.last(50)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(p,)) for p in 'abcd']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(storage), 50)
+
+
 class Test_escape(unittest.TestCase):
     def test_escape(self):
         from pyramid_debugtoolbar.utils import escape
@@ -18,6 +108,93 @@ class Test_escape(unittest.TestCase):
         assert escape(Foo('<foo>')) == '<foo>'
 
 
+class Test_estimate_size(unittest.TestCase):
+    def _callFUT(self, obj, seen=None):
+        from pyramid_debugtoolbar.utils import estimate_size
+
+        return estimate_size(obj, seen)
+
+    def test_nested(self):
+        blob = b'x' * 10000
+        size = self._callFUT({'a': [blob, (blob,)]})
+        self.assertGreater(size, 10000)
+        self.assertLess(size, 20000)
+
+    def test_instance(self):
+        class Foo:
+            def __init__(self):
+                self.blob = b'x' * 10000
+
+        self.assertGreater(self._callFUT(Foo()), 10000)
+
+    def test_slots(self):
+        class Foo:
+            __slots__ = ('blob',)
+
+            def __init__(self):
+                self.blob = b'x' * 10000
+
+        self.assertGreater(self._callFUT(Foo()), 10000)
+
+    def test_seen(self):
+        blob = b'x' * 10000
+        seen = set()
+        self.assertGreater(self._callFUT([blob], seen), 10000)
+        self.assertLess(self._callFUT([blob], seen), 10000)
+
+    def test_ignores_registry(self):
+        from pyramid.registry import Registry
+
+        registry = Registry()
+        registry.blob = b'x' * 10000
+        self.assertLess(self._callFUT([registry]), 10000)
+
+    def test_traceback_frames_only(self):
+        def caller():
+            blob = b'x' * 100000  # noqa: F841
+            try:
+                raise_error()
+            except ValueError:
+                return sys.exc_info()[2]
+
+        def raise_error():
+            blob = b'y' * 10000  # noqa: F841
+            raise ValueError
+
+        tb = caller()
+        # the frames of the caller and raise_error with their locals, but
+        # not the frames of the test runner calling them
+        size = self._callFUT(tb)
+        self.assertGreater(size, 110000)
+        self.assertLess(size, 150000)
+        self.assertLess(self._callFUT(tb.tb_next), 50000)
+
+    def test_ignores_module_globals(self):
+        self.assertLess(self._callFUT([vars(unittest)]), 1000)
+
+
+class Test_get_registry_singleton(unittest.TestCase):
+    def _callFUT(self, registry, attr, factory):
+        from pyramid_debugtoolbar.utils import get_registry_singleton
+
+        return get_registry_singleton(registry, attr, factory)
+
+    def test_created_once(self):
+        from pyramid.registry import Registry
+
+        registry = Registry()
+        calls = []
+
+        def factory():
+            calls.append(None)
+            return {}
+
+        value = self._callFUT(registry, 'pdtb_test', factory)
+        self.assertIs(registry.pdtb_test, value)
+        self.assertIs(self._callFUT(registry, 'pdtb_test', factory), value)
+        self.assertEqual(len(calls), 1)
+
+
 class Test_format_fname(unittest.TestCase):
     def _callFUT(self, value, sys_path=None):
         from pyramid_debugtoolbar.utils import format_fname
@@ -78,6 +255,67 @@ class Test_format_sql(unittest.TestCase):
         self.assertTrue(result.startswith('<div'))
 
 
+class Test_replace_insensitive(unittest.TestCase):
+    def _callFUT(self, string, window=None):
+        from pyramid_debugtoolbar.utils import replace_insensitive
+
+        return replace_insensitive(string, b'</body>', b'X</body>', window)
+
+    def test_replaces_last(self):
+        result = self._callFUT(b'</body></BODY>')
+        self.assertEqual(result, b'</body>X</body>')
+
+    def test_not_found(self):
+        self.assertEqual(self._callFUT(b'<body>', 2), b'<body>')
+
+    def test_found_in_window(self):
+        result = self._callFUT(b'a' * 100 + b'</BODY>', 10)
+        self.assertEqual(result, b'a' * 100 + b'X</body>')
+
+    def test_found_before_window(self):
+        result = self._callFUT(b'</body>' + b'a' * 100, 10)
+        self.assertEqual(result, b'X</body>' + b'a' * 100)
+
+
+class TestReplaceInsensitiveIter(unittest.TestCase):
+    def _makeOne(self, app_iter, window=100):
+        from pyramid_debugtoolbar.utils import ReplaceInsensitiveIter
+
+        return ReplaceInsensitiveIter(
+            app_iter, b'</body>', b'X</body>', window
+        )
+
+    def test_target_split_between_chunks(self):
+        chunks = [b'<body>a</bo', b'', b'DY></html>']
+        result = list(self._makeOne(chunks))
+        self.assertEqual(b''.join(result), b'<body>aX</body></html>')
+        self.assertEqual(result[0], b'<body')
+
+    def test_replaces_last(self):
+        chunks = [b'</body>', b'a' * 20, b'</body>', b'b']
+        result = b''.join(self._makeOne(chunks))
+        self.assertEqual(result, b'</body>' + b'a' * 20 + b'X</body>b')
+
+    def test_streams_chunks(self):
+        chunks = [b'a' * 50] * 10 + [b'</body>']
+        app_iter = iter(self._makeOne(chunks))
+        self.assertEqual(len(next(app_iter)), 44)
+
+    def test_target_too_far_from_end(self):
+        chunks = [b'</body>', b'a' * 200]
+        result = b''.join(self._makeOne(chunks))
+        self.assertEqual(result, b'</body>' + b'a' * 200)
+
+    def test_not_found(self):
+        result = b''.join(self._makeOne([b'a', b'b']))
+        self.assertEqual(result, b'ab')
+
+    def test_close(self):
+        app_iter = DummyAppIter([b'</body>'])
+        self._makeOne(app_iter).close()
+        self.assertTrue(app_iter.closed)
+
+
 class Test_addr_in(unittest.TestCase):
     def _callFUT(self, addr, hosts):
         from pyramid_debugtoolbar.utils import addr_in
@@ -115,3 +353,61 @@ class Test_addr_in(unittest.TestCase):
         self.assertTrue(
             self._callFUT('fe80::e556:2a1a:91e2:7023%15', ['::/0'])
         )
+
+
+class Test_make_addr_matcher(unittest.TestCase):
+    def _callFUT(self, hosts):
+        from pyramid_debugtoolbar.utils import make_addr_matcher
+
+        return make_addr_matcher(hosts)
+
+    def test_empty_hosts(self):
+        match = self._callFUT([])
+        self.assertFalse(match('127.0.0.1'))
+        self.assertFalse(match('not an address'))
+
+    def test_addresses(self):
+        match = self._callFUT(['127.0.0.1', '::1'])
+        self.assertTrue(match('127.0.0.1'))
+        self.assertTrue(match('::1'))
+        self.assertFalse(match('127.0.0.2'))
+
+    def test_networks(self):
+        match = self._callFUT(['10.0.0.1', '127.0.0.0/24', 'fc00::/7'])
+        self.assertTrue(match('127.0.0.254'))
+        self.assertTrue(match('fd00::1'))
+        self.assertFalse(match('127.0.1.1'))
+        self.assertFalse(match('::1'))
+
+    def test_ipv6_interface(self):
+        match = self._callFUT(['::/0'])
+        self.assertTrue(match('fe80::e556:2a1a:91e2:7023%15'))
+
+    def test_invalid_host(self):
+        from pyramid.exceptions import ConfigurationError
+
+        with self.assertRaises(ConfigurationError) as cm:
+            self._callFUT(['127.0.0.1', 'localhost'])
+        self.assertIn('debugtoolbar.hosts', str(cm.exception))
+        self.assertIn('localhost', str(cm.exception))
+
+    def test_decisions_are_cached(self):
+        match = self._callFUT(['127.0.0.0/24'])
+        match('127.0.0.1')
+        match('127.0.0.1')
+        self.assertEqual(match.cache_info().hits, 1)
+
+
+class DummyAppIter(list):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class DummyToolbar:
+    def __init__(self, size):
+        self.size = size
+
+    def estimate_size(self):
+        return self.size